@@ -0,0 +1,64 @@
+"""Comparar la memoria de la caché: listas de texto vs registros compactos
+
+Uso: python benchmark_memoria.py [filas]
+"""
+import json
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from bot import Venta
+
+def generar_respuesta(filas):
+    """Simular la respuesta JSON de Sheets para la pestaña Ventas"""
+    random.seed(42)
+    clientes = [f"Cliente {i}" for i in range(300)]
+    inicio = date(2022, 1, 1)
+
+    valores = []
+    for _ in range(filas):
+        fecha = inicio + timedelta(days=random.randint(0, 3 * 365))
+        valores.append([
+            random.choice(clientes),
+            fecha.strftime("%d/%m/%Y"),
+            str(random.randint(1, 20)),
+            str(random.randint(1, 200) * 500),
+            str(random.choice([0, 0, 0, 1000, 5000])),
+            random.choice(['Nequi', 'Efectivo']),
+        ])
+    return json.dumps({'values': valores})
+
+def medir(nombre, construir, respuesta):
+    """Medir memoria retenida y tiempo de construcción y de una suma completa"""
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    datos = construir(json.loads(respuesta)['values'])
+    construccion = time.perf_counter() - inicio
+    memoria, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    inicio = time.perf_counter()
+    if isinstance(datos[0], list):
+        total = sum(float(row[3]) for row in datos)
+    else:
+        total = sum(venta.valor for venta in datos)
+    suma = time.perf_counter() - inicio
+
+    print(
+        f"{nombre:<18} {memoria / 1024 / 1024:>8.1f} MB {memoria / len(datos):>8.0f} B/fila "
+        f"{construccion * 1000:>8.0f} ms {suma * 1000:>8.1f} ms  (total ${total:,.0f})"
+    )
+
+def main():
+    filas = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    respuesta = generar_respuesta(filas)
+
+    print(f"Ventas simuladas: {filas:,}\n")
+    print(f"{'Representación':<18} {'Memoria':>11} {'Por fila':>12} {'Carga':>11} {'Suma':>11}")
+    medir("Listas de texto", lambda valores: valores, respuesta)
+    medir("Registros Venta", lambda valores: [Venta(row) for row in valores], respuesta)
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,45 @@
+import time
+
+# Marca de inicio para medir el tiempo de arranque
+INICIO_PROCESO = time.perf_counter()
+
 import logging
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import (
+    Update,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+    InlineQueryResultArticle,
+    InputTextMessageContent
+)
 from telegram.ext import (
+    Application,
     ApplicationBuilder, 
     CommandHandler, 
     MessageHandler, 
+    InlineQueryHandler,
     ConversationHandler,
     ContextTypes,
     filters
 )
+from telegram.request import HTTPXRequest
 import os
+import sys
+import json
+import asyncio
+import threading
+import bisect
+import heapq
+import unicodedata
+import csv
+import gzip
+import io
+import tempfile
+import uuid
+import hashlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from google.auth.transport.requests import Request
-from google.oauth2.service_account import Credentials
-from googleapiclient import discovery
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Cargar variables de entorno
 load_dotenv()
@@ -39,17 +65,669 @@ AWAITING_METODO_VENTA = 5
 AWAITING_GASTO = 6
 AWAITING_COSTO = 7
 AWAITING_METODO_GASTO = 8
+AWAITING_CATEGORIA_GASTO = 10
+AWAITING_SUBCATEGORIA_GASTO = 11
+
+AWAITING_ARCHIVO_IMPORTAR = 9
+
+# Estructura de las pestañas de la hoja de cálculo
+HOJAS = {
+    'ventas': {
+        'titulo': 'Ventas',
+        'columnas': ['Cliente', 'Fecha', 'Cantidad', 'Valor', 'Deuda', 'Método', 'ID'],
+        'numericas': [2, 3, 4],
+        'fechas': [1],
+        'texto': [0, 5],
+        'id': 6,
+    },
+    'gastos': {
+        'titulo': 'Gastos',
+        'columnas': ['Gasto', 'Costo', 'Método', 'Fecha', 'Categoría', 'Subcategoría', 'ID'],
+        'numericas': [1],
+        'fechas': [3],
+        'texto': [0, 2, 4, 5],
+        'id': 6,
+    },
+}
+
+# Categorías y subcategorías de gastos
+CATEGORIAS_GASTO = {
+    'Insumos': ['Fruta', 'Empaques', 'Otros insumos'],
+    'Operación': ['Arriendo', 'Servicios', 'Transporte', 'Mantenimiento'],
+    'Personal': ['Nómina', 'Bonificaciones'],
+    'Otros': ['Impuestos', 'Varios'],
+}
+
+# Filas leídas por cada llamada a la API al exportar
+TAMANO_BLOQUE = 1000
+# Filas enviadas por cada llamada a la API al importar
+TAMANO_LOTE = 500
+
+# Pestaña oculta con fórmulas que resumen cada hoja para detectar cambios
+HOJA_CONTROL = '_Control'
+# Segundos mínimos entre dos consultas a la pestaña de control
+INTERVALO_SONDEO = int(os.getenv("INTERVALO_SONDEO", "30"))
+# Segundos máximos de espera antes de volver a preparar la pestaña de control
+MAXIMO_REINTENTO_CONTROL = 3600
+
+# Intentos de escritura antes de reportar un error y espera inicial entre ellos
+INTENTOS_ESCRITURA = 3
+ESPERA_REINTENTO = 1.0
 
 # Configurar Google Sheets API
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
+# Las librerías de Google se importan en el primer uso para acelerar el arranque.
+# Las credenciales y el documento de discovery se comparten; el servicio se
+# construye una vez por hilo porque httplib2 no es seguro entre hilos.
+_credenciales = None
+_documento_discovery = None
+_lock_sheets = threading.Lock()
+_sheets_local = threading.local()
+
+def preparar_sheets():
+    """Importar las librerías de Google y cargar credenciales y discovery"""
+    global _credenciales, _documento_discovery
+    
+    with _lock_sheets:
+        if _documento_discovery is None:
+            from google.oauth2.service_account import Credentials
+            from googleapiclient import discovery_cache
+            
+            _credenciales = Credentials.from_service_account_file(
+                CREDENTIALS_FILE, scopes=SCOPES)
+            # Documento de discovery incluido en googleapiclient, sin descargarlo
+            _documento_discovery = json.loads(discovery_cache.get_static_doc('sheets', 'v4'))
+    
+    return _credenciales, _documento_discovery
+
 def get_sheets_service():
     """Obtener el servicio de Google Sheets"""
-    credentials = Credentials.from_service_account_file(
-        CREDENTIALS_FILE, scopes=SCOPES)
-    service = discovery.build('sheets', 'v4', credentials=credentials)
+    service = getattr(_sheets_local, 'service', None)
+    
+    if service is None:
+        from googleapiclient import discovery
+        
+        credentials, documento = preparar_sheets()
+        service = discovery.build_from_document(documento, credentials=credentials)
+        _sheets_local.service = service
+    
     return service
 
+# ============ CACHÉ Y DETECCIÓN DE CAMBIOS ============
+
+def letra_columna(numero):
+    """Convertir un número de columna (1 = A) a su letra en notación A1"""
+    letras = ""
+    while numero > 0:
+        numero, resto = divmod(numero - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+def rango_hoja(hoja, fila_inicio=1, fila_fin=None):
+    """Construir el rango A1 que cubre todas las columnas de una hoja"""
+    datos = HOJAS[hoja]
+    ultima = letra_columna(len(datos['columnas']))
+    if fila_fin is None:
+        return f"{datos['titulo']}!A{fila_inicio}:{ultima}"
+    return f"{datos['titulo']}!A{fila_inicio}:{ultima}{fila_fin}"
+
+def formulas_control(hoja):
+    """Fórmulas que resumen una hoja: filas con datos, suma numérica y largo del texto"""
+    datos = HOJAS[hoja]
+    
+    def columna(i):
+        letra = letra_columna(i + 1)
+        return f"{datos['titulo']}!{letra}2:{letra}"
+    
+    conteo = f"=COUNTA({columna(0)})"
+    # Las fechas se resumen con los dígitos del texto mostrado, que es el que lee
+    # el bot, para no depender de cómo interpreta la fecha la configuración regional
+    suma = "=" + "+".join(
+        [f"SUM({columna(i)})" for i in datos['numericas']]
+        + [f'SUMPRODUCT(IFERROR(VALUE(REGEXREPLACE(TO_TEXT({columna(i)}), "\\D", "")), 0))' for i in datos['fechas']]
+    )
+    largo = "=" + "+".join(f"SUMPRODUCT(LEN({columna(i)}))" for i in datos['texto'])
+    return [hoja, conteo, suma, largo]
+
+def firmas_coinciden(local, remota):
+    """Comparar dos firmas (conteo, suma, largo) tolerando redondeo en la suma"""
+    return (
+        local[0] == remota[0]
+        and abs(local[1] - remota[1]) < 0.005
+        and local[2] == remota[2]
+    )
+
+def _texto(row, i):
+    """Texto de una celda, internado para compartir los valores repetidos"""
+    return sys.intern(row[i]) if len(row) > i else ""
+
+def _numero(row, i):
+    """Número de una celda: 0 si falta, None si no es un número válido"""
+    if len(row) <= i:
+        return 0.0
+    try:
+        return float(row[i])
+    except ValueError:
+        return None
+
+def parsear_fecha(texto):
+    """Convertir una fecha dd/mm/aaaa de la hoja. Retorna None si no es válida"""
+    try:
+        return datetime.strptime(texto, "%d/%m/%Y").date()
+    except ValueError:
+        return None
+
+def digitos_fecha(texto):
+    """Número formado por los dígitos de una fecha tal como se muestra (19/10/2026 -> 19102026)"""
+    digitos = "".join(filter(str.isdigit, texto))
+    return int(digitos) if digitos else 0
+
+class Venta:
+    """Fila de la pestaña Ventas"""
+    __slots__ = ('cliente', 'fecha', 'cantidad', 'valor', 'deuda', 'metodo')
+    
+    def __init__(self, row):
+        self.cliente = _texto(row, 0)
+        self.fecha = _texto(row, 1)
+        self.cantidad = _numero(row, 2)
+        self.valor = _numero(row, 3)
+        self.deuda = _numero(row, 4)
+        self.metodo = _texto(row, 5)
+
+class Gasto:
+    """Fila de la pestaña Gastos"""
+    __slots__ = ('descripcion', 'costo', 'metodo', 'fecha', 'categoria', 'subcategoria')
+    
+    def __init__(self, row):
+        self.descripcion = _texto(row, 0)
+        self.costo = _numero(row, 1)
+        self.metodo = _texto(row, 2)
+        self.fecha = _texto(row, 3)
+        self.categoria = _texto(row, 4)
+        self.subcategoria = _texto(row, 5)
+
+REGISTROS = {'ventas': Venta, 'gastos': Gasto}
+
+class CacheHoja:
+    """Copia en memoria de una hoja que se actualiza solo cuando cambia su firma"""
+    
+    def __init__(self, hoja):
+        self.hoja = hoja
+        self.registros = []  # Un registro por fila, incluidas las vacías y sin las duplicadas
+        self.ids = set()  # IDs de idempotencia ya vistos
+        self.filas = 0  # Filas leídas de la hoja, incluidas las duplicadas
+        self.duplicadas = 0
+        self.generacion = 0  # Aumenta en cada recarga completa
+        self.firma = None  # Última firma remota sincronizada
+        self.conteo = 0
+        self.suma = 0.0
+        self.largo = 0
+        # lectura ordena las consultas a Sheets; lock solo protege el cambio de estado,
+        # así los índices nunca esperan una llamada de red
+        self.lectura = threading.Lock()
+        self.lock = threading.Lock()
+    
+    def firma_local(self):
+        return (self.conteo, self.suma, self.largo)
+    
+    def _resumir(self, filas, ids):
+        """Convertir filas leídas en registros y en su aporte a la firma, sin tocar la caché"""
+        datos = HOJAS[self.hoja]
+        registro = REGISTROS[self.hoja]
+        lectura = {
+            'registros': [], 'ids': set(), 'filas': len(filas),
+            'duplicadas': 0, 'conteo': 0, 'suma': 0.0, 'largo': 0,
+        }
+        
+        for row in filas:
+            if row and row[0] != "":
+                lectura['conteo'] += 1
+            
+            for i in datos['numericas']:
+                try:
+                    lectura['suma'] += float(row[i]) if len(row) > i and row[i] != "" else 0
+                except ValueError:
+                    continue
+            
+            for i in datos['fechas']:
+                if len(row) > i:
+                    lectura['suma'] += digitos_fecha(row[i])
+            
+            for i in datos['texto']:
+                if len(row) > i:
+                    lectura['largo'] += len(row[i])
+            
+            # Una fila con un ID ya visto es un reintento que llegó dos veces
+            identificador = row[datos['id']] if len(row) > datos['id'] else ""
+            if identificador:
+                if identificador in ids or identificador in lectura['ids']:
+                    lectura['duplicadas'] += 1
+                    continue
+                lectura['ids'].add(identificador)
+            
+            lectura['registros'].append(registro(row))
+        
+        return lectura
+    
+    def recargar(self, service):
+        """Leer la hoja completa"""
+        result = service.spreadsheets().values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=rango_hoja(self.hoja, 2)  # Saltar encabezado
+        ).execute()
+        
+        lectura = self._resumir(result.get('values', []), set())
+        
+        with self.lock:
+            self.registros = lectura['registros']
+            self.ids = lectura['ids']
+            self.filas = lectura['filas']
+            self.duplicadas = lectura['duplicadas']
+            self.conteo = lectura['conteo']
+            self.suma = lectura['suma']
+            self.largo = lectura['largo']
+            self.generacion += 1
+    
+    def leer_nuevas(self, service):
+        """Leer solo las filas agregadas después de la última conocida"""
+        result = service.spreadsheets().values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=rango_hoja(self.hoja, self.filas + 2)
+        ).execute()
+        
+        lectura = self._resumir(result.get('values', []), self.ids)
+        
+        with self.lock:
+            self.registros.extend(lectura['registros'])
+            self.ids |= lectura['ids']
+            self.filas += lectura['filas']
+            self.duplicadas += lectura['duplicadas']
+            self.conteo += lectura['conteo']
+            self.suma += lectura['suma']
+            self.largo += lectura['largo']
+    
+    def confirmar(self, service, identificadores):
+        """Leer las filas nuevas y retornar cuáles de los IDs ya están en la hoja"""
+        with self.lectura:
+            if self.generacion:
+                self.leer_nuevas(service)
+            else:
+                self.recargar(service)
+        
+        with self.lock:
+            return {identificador for identificador in identificadores if identificador in self.ids}
+    
+    def sincronizar(self, service, firma_remota):
+        """Actualizar la caché según la firma remota. Retorna el tipo de actualización"""
+        with self.lectura:
+            if self.generacion and firma_remota is not None and firma_remota == self.firma:
+                return None
+            
+            # Si solo se agregaron filas al final, basta con leerlas
+            if self.generacion and firma_remota is not None:
+                self.leer_nuevas(service)
+                if firmas_coinciden(self.firma_local(), firma_remota):
+                    self.firma = firma_remota
+                    return 'delta'
+            
+            self.recargar(service)
+            self.firma = firma_remota
+            return 'completa'
+
+CACHE = {hoja: CacheHoja(hoja) for hoja in HOJAS}
+
+# control: None = sin verificar, False = no disponible (se recarga todo en cada sondeo
+# hasta que la preparación vuelva a intentarse en el instante 'reintento_control')
+estado_sondeo = {
+    'ultimo': 0.0, 'control': None, 'sondeos': 0, 'lecturas': 0,
+    'fallos_control': 0, 'reintento_control': 0.0,
+}
+_lock_sondeo = threading.Lock()
+
+def asegurar_hoja_control(service):
+    """Crear la pestaña oculta de control y escribir sus fórmulas"""
+    result = service.spreadsheets().get(
+        spreadsheetId=SPREADSHEET_ID,
+        fields='sheets.properties.title'
+    ).execute()
+    titulos = [sheet['properties']['title'] for sheet in result.get('sheets', [])]
+    
+    if HOJA_CONTROL not in titulos:
+        service.spreadsheets().batchUpdate(
+            spreadsheetId=SPREADSHEET_ID,
+            body={'requests': [
+                {'addSheet': {'properties': {'title': HOJA_CONTROL, 'hidden': True}}}
+            ]}
+        ).execute()
+    
+    # Se reescriben siempre para que sigan las columnas definidas en HOJAS
+    service.spreadsheets().values().update(
+        spreadsheetId=SPREADSHEET_ID,
+        range=f"{HOJA_CONTROL}!A1",
+        valueInputOption='USER_ENTERED',
+        body={'values': [formulas_control(hoja) for hoja in HOJAS]}
+    ).execute()
+
+def completar_encabezados(service):
+    """Escribir los títulos de columna que falten en la primera fila de cada hoja"""
+    result = service.spreadsheets().values().batchGet(
+        spreadsheetId=SPREADSHEET_ID,
+        ranges=[rango_hoja(hoja, 1, 1) for hoja in HOJAS]
+    ).execute()
+    
+    for hoja, rango in zip(HOJAS, result.get('valueRanges', [])):
+        actuales = rango.get('values', [[]])[0]
+        faltantes = HOJAS[hoja]['columnas'][len(actuales):]
+        
+        if faltantes:
+            service.spreadsheets().values().update(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{HOJAS[hoja]['titulo']}!{letra_columna(len(actuales) + 1)}1",
+                valueInputOption='RAW',
+                body={'values': [faltantes]}
+            ).execute()
+
+def ocultar_columnas_id(service):
+    """Ocultar la columna de IDs de idempotencia en cada hoja"""
+    result = service.spreadsheets().get(
+        spreadsheetId=SPREADSHEET_ID,
+        fields='sheets.properties(sheetId,title)'
+    ).execute()
+    ids_hojas = {
+        sheet['properties']['title']: sheet['properties']['sheetId']
+        for sheet in result.get('sheets', [])
+    }
+    
+    solicitudes = [
+        {'updateDimensionProperties': {
+            'range': {
+                'sheetId': ids_hojas[datos['titulo']],
+                'dimension': 'COLUMNS',
+                'startIndex': datos['id'],
+                'endIndex': datos['id'] + 1,
+            },
+            'properties': {'hiddenByUser': True},
+            'fields': 'hiddenByUser',
+        }}
+        for datos in HOJAS.values() if datos['titulo'] in ids_hojas
+    ]
+    
+    if solicitudes:
+        service.spreadsheets().batchUpdate(
+            spreadsheetId=SPREADSHEET_ID,
+            body={'requests': solicitudes}
+        ).execute()
+
+def desactivar_control(error):
+    """Leer las hojas completas hasta volver a preparar la pestaña de control más tarde"""
+    # Un error pasajero no debe dejar al bot leyendo las hojas completas para siempre
+    estado_sondeo['fallos_control'] += 1
+    espera = min(INTERVALO_SONDEO * 2 ** estado_sondeo['fallos_control'], MAXIMO_REINTENTO_CONTROL)
+    estado_sondeo['reintento_control'] = time.monotonic() + espera
+    estado_sondeo['control'] = False
+    logger.warning(f"Hoja de control no disponible, se leerán las hojas completas y se reintentará en {espera}s: {error}")
+
+def leer_firmas(service):
+    """Leer la firma de cada hoja desde la pestaña de control"""
+    if not estado_sondeo['control'] and time.monotonic() >= estado_sondeo['reintento_control']:
+        try:
+            completar_encabezados(service)
+            ocultar_columnas_id(service)
+            asegurar_hoja_control(service)
+            estado_sondeo['control'] = True
+            estado_sondeo['fallos_control'] = 0
+        except Exception as e:
+            desactivar_control(e)
+    
+    if not estado_sondeo['control']:
+        return {}
+    
+    # Si la pestaña se borró o renombró, se vuelve a crear en el próximo reintento
+    try:
+        result = service.spreadsheets().values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"{HOJA_CONTROL}!A1:D{len(HOJAS)}",
+            valueRenderOption='UNFORMATTED_VALUE'
+        ).execute()
+    except Exception as e:
+        desactivar_control(e)
+        return {}
+    
+    firmas = {}
+    for row in result.get('values', []):
+        try:
+            firmas[row[0]] = (int(row[1]), float(row[2]), int(row[3]))
+        except (ValueError, TypeError, IndexError):
+            continue
+    return firmas
+
+def sondear_cambios(forzar=False):
+    """Consultar la firma de las hojas y refrescar solo las que cambiaron"""
+    with _lock_sondeo:
+        if not forzar and time.monotonic() - estado_sondeo['ultimo'] < INTERVALO_SONDEO:
+            return
+        
+        try:
+            service = get_sheets_service()
+            firmas = leer_firmas(service)
+            estado_sondeo['sondeos'] += 1
+            
+            for hoja, cache in CACHE.items():
+                tipo = cache.sincronizar(service, firmas.get(hoja))
+                if tipo:
+                    estado_sondeo['lecturas'] += 1
+                    logger.info(f"Caché de {HOJAS[hoja]['titulo']} actualizada ({tipo}): {len(cache.registros)} filas")
+        finally:
+            # Tras un error también se espera el intervalo antes de volver a consultar
+            estado_sondeo['ultimo'] = time.monotonic()
+
+def marcar_pendiente():
+    """Forzar un sondeo en la próxima lectura (después de escribir en la hoja)"""
+    estado_sondeo['ultimo'] = 0.0
+
+def obtener_registros(hoja):
+    """Obtener los registros de una hoja desde la caché"""
+    try:
+        sondear_cambios()
+    except Exception as e:
+        # Con la caché ya cargada es mejor responder con datos algo viejos que fallar
+        if not CACHE[hoja].generacion:
+            raise
+        logger.warning(f"No se pudo sondear Google Sheets, se usa la caché de {HOJAS[hoja]['titulo']}: {e}")
+    return CACHE[hoja].registros
+
+# ============ ESCRITURA IDEMPOTENTE ============
+
+def nuevo_id():
+    """ID de idempotencia para un registro nuevo (empieza con letra para que Sheets no lo lea como número)"""
+    return "r" + uuid.uuid4().hex
+
+def contenido_importado(hoja, fila):
+    """Huella del contenido de una fila importada (sin su ID), independiente de su posición"""
+    # Los textos se comparan sin tildes, mayúsculas ni espacios sobrantes
+    valores = [
+        clave_cliente(valor) if i in HOJAS[hoja]['texto'] else valor
+        for i, valor in enumerate(fila[:HOJAS[hoja]['id']])
+    ]
+    contenido = json.dumps([hoja, valores], ensure_ascii=False)
+    return hashlib.sha1(contenido.encode('utf-8')).digest()
+
+def id_importado(huella, ocurrencia):
+    """ID determinista de una fila importada, para que reimportar un archivo no la duplique"""
+    return "i" + hashlib.sha1(huella + str(ocurrencia).encode('ascii')).hexdigest()[:32]
+
+def agregar_filas(service, hoja, filas, reintento=False):
+    """Agregar filas con ID a una hoja, reintentando sin duplicarlas. Retorna (escritas, confirmadas)"""
+    # confirmadas: filas que se encontraron en la hoja tras un intento con error que sí llegó
+    cache = CACHE[hoja]
+    columna = HOJAS[hoja]['id']
+    confirmadas = 0
+    
+    with cache.lock:
+        pendientes = [fila for fila in filas if fila[columna] not in cache.ids]
+    
+    for intento in range(1, INTENTOS_ESCRITURA + 1):
+        if not pendientes:
+            break
+        
+        # Un error de red no garantiza que la escritura falló: antes de reintentar
+        # (o si las filas ya se intentaron en una llamada anterior) se leen las
+        # filas nuevas y se descartan las que ya llegaron
+        if intento > 1 or reintento:
+            confirmados = cache.confirmar(service, [fila[columna] for fila in pendientes])
+            pendientes = [fila for fila in pendientes if fila[columna] not in confirmados]
+            confirmadas += len(confirmados)
+            if not pendientes:
+                break
+        
+        try:
+            service.spreadsheets().values().append(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{HOJAS[hoja]['titulo']}!A2",
+                valueInputOption='USER_ENTERED',
+                insertDataOption='INSERT_ROWS',
+                body={'values': pendientes}
+            ).execute()
+            marcar_pendiente()
+            return len(pendientes), confirmadas
+        except Exception as e:
+            if intento == INTENTOS_ESCRITURA:
+                raise
+            logger.warning(f"Error al escribir en {HOJAS[hoja]['titulo']} (intento {intento}), reintentando: {e}")
+            time.sleep(ESPERA_REINTENTO * 2 ** (intento - 1))
+    
+    marcar_pendiente()
+    return 0, confirmadas
+
+# ============ ÍNDICES EN MEMORIA ============
+
+class IndiceIncremental(ABC):
+    """Índice derivado de una caché que procesa solo los registros nuevos"""
+    
+    def __init__(self, hoja):
+        self.hoja = hoja
+        self.generacion = None
+        self.procesadas = 0
+        self.lock = threading.Lock()
+        self.reiniciar()
+    
+    @abstractmethod
+    def reiniciar(self):
+        """Vaciar el índice (se llama al crearlo y tras cada recarga completa)"""
+    
+    @abstractmethod
+    def agregar(self, registro):
+        """Incorporar un registro nuevo de la caché"""
+    
+    def sincronizar(self):
+        """Ponerse al día con la caché sin consultar Google Sheets"""
+        cache = CACHE[self.hoja]
+        
+        with self.lock:
+            with cache.lock:
+                generacion = cache.generacion
+                registros = cache.registros
+            
+            # Una recarga completa puede haber cambiado cualquier fila
+            if generacion != self.generacion:
+                self.reiniciar()
+                self.generacion = generacion
+                self.procesadas = 0
+            
+            nuevos = registros[self.procesadas:]
+            for registro in nuevos:
+                self.agregar(registro)
+            self.procesadas += len(nuevos)
+
+def limpiar_nombre(nombre):
+    """Quitar espacios sobrantes y capitalizar nombres escritos en minúsculas"""
+    nombre = " ".join(nombre.split())
+    return nombre.title() if nombre.islower() else nombre
+
+def clave_cliente(nombre):
+    """Clave de comparación de un cliente: sin tildes, mayúsculas ni espacios sobrantes"""
+    sin_tildes = unicodedata.normalize('NFKD', nombre)
+    sin_tildes = "".join(c for c in sin_tildes if not unicodedata.combining(c))
+    return " ".join(sin_tildes.casefold().split())
+
+# Número de ventas tras las cuales la recencia de un cliente pesa la mitad
+VIDA_MEDIA_CLIENTE = 50
+
+class IndiceClientes(IndiceIncremental):
+    """Clientes ordenados por frecuencia y recencia para sugerir nombres"""
+    
+    def reiniciar(self):
+        self.clientes = {}  # clave -> {'nombres', 'frecuencia', 'ultima'}
+        self.claves = []  # Ordenadas para buscar por prefijo
+        self.ventas = 0
+    
+    def agregar(self, venta):
+        if not venta.cliente.strip():
+            return
+        
+        clave = clave_cliente(venta.cliente)
+        nombre = " ".join(venta.cliente.split())
+        self.ventas += 1
+        
+        datos = self.clientes.get(clave)
+        if datos is None:
+            datos = self.clientes[clave] = {'nombres': {}, 'frecuencia': 0, 'ultima': 0}
+            bisect.insort(self.claves, clave)
+        
+        datos['nombres'][nombre] = datos['nombres'].get(nombre, 0) + 1
+        datos['frecuencia'] += 1
+        datos['ultima'] = self.ventas
+    
+    def nombre(self, clave):
+        """Forma más usada del nombre de un cliente"""
+        nombres = self.clientes[clave]['nombres']
+        return max(nombres, key=nombres.get)
+    
+    def puntaje(self, clave):
+        datos = self.clientes[clave]
+        antiguedad = self.ventas - datos['ultima']
+        return datos['frecuencia'] * 0.5 ** (antiguedad / VIDA_MEDIA_CLIENTE)
+    
+    def sugerencias(self, texto="", limite=6):
+        """Clientes que empiezan por el texto (o alguna de sus palabras), mejor puntuados primero"""
+        with self.lock:
+            prefijo = clave_cliente(texto)
+            
+            if not prefijo:
+                candidatos = self.clientes.keys()
+            else:
+                inicio = bisect.bisect_left(self.claves, prefijo)
+                candidatos = set()
+                for clave in self.claves[inicio:]:
+                    if not clave.startswith(prefijo):
+                        break
+                    candidatos.add(clave)
+                
+                if len(candidatos) < limite:
+                    candidatos.update(
+                        clave for clave in self.claves
+                        if any(palabra.startswith(prefijo) for palabra in clave.split())
+                    )
+            
+            mejores = heapq.nlargest(limite, candidatos, key=self.puntaje)
+            return [(self.nombre(clave), self.clientes[clave]['frecuencia']) for clave in mejores]
+    
+    def canonico(self, nombre):
+        """Nombre con el que se debe guardar un cliente"""
+        with self.lock:
+            clave = clave_cliente(nombre)
+            if clave in self.clientes:
+                return self.nombre(clave)
+        return limpiar_nombre(nombre)
+
+INDICE_CLIENTES = IndiceClientes('ventas')
+
+def obtener_indice_clientes():
+    """Índice de clientes actualizado con lo que ya hay en caché"""
+    INDICE_CLIENTES.sincronizar()
+    return INDICE_CLIENTES
+
 # ============ COMANDOS PRINCIPALES ============
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -57,7 +735,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = [
         ['➕ Agregar Compra', '💸 Agregar Gasto'],
         ['📊 Ver Total de Ventas', '📉 Ver Total de Gastos'],
-        ['📋 Ver Balance'],
+        ['📋 Ver Balance', '📂 Gastos por Categoría'],
         ['👥 Resumen Clientes', '💰 Resumen Gastos'],
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -84,6 +762,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 /cliente <nombre> - Ver detalles de un cliente
 /resumen_gastos - Ver resumen de gastos
 /gasto <descripción> - Ver detalles de un gasto
+/categorias [categoría] [mes|todo|aaaa-mm] - Ver gastos por categoría
+/analitica [7|30|90] - Ver analítica de ventas
+/grafico <ventas|gastos|balance> - Ver un gráfico
+/exportar <ventas|gastos> [gz] - Descargar una hoja en CSV
+/importar <ventas|gastos> - Cargar registros desde un CSV
+/estado - Ver métricas de arranque y caché
     """
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
@@ -91,19 +775,54 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def agregar_compra(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Iniciar el proceso de agregar una compra"""
+    # Sugerir los clientes más frecuentes y recientes (el índice se pone al día en un hilo)
+    sugerencias = await asyncio.to_thread(lambda: obtener_indice_clientes().sugerencias())
+    sugerencias = [nombre for nombre, _ in sugerencias]
+    
+    if sugerencias:
+        keyboard = [sugerencias[i:i + 2] for i in range(0, len(sugerencias), 2)]
+        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    else:
+        reply_markup = ReplyKeyboardRemove()
+    
+    # Un ID por registro: los reintentos lo reutilizan y no duplican la venta
+    context.user_data['id'] = nuevo_id()
+    
+    usuario_bot = context.bot.username.replace('_', '\\_')
+    
     await update.message.reply_text(
         "📝 *Nuevo Registro de Venta*\n\n"
-        "¿Cuál es el nombre del cliente?",
-        parse_mode='Markdown'
+        "¿Cuál es el nombre del cliente?\n"
+        f"Puedes elegirlo abajo o buscarlo escribiendo @{usuario_bot} nombre",
+        parse_mode='Markdown',
+        reply_markup=reply_markup
     )
     return AWAITING_CLIENTE
 
 async def recibir_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Recibir nombre del cliente"""
-    context.user_data['cliente'] = update.message.text
-    await update.message.reply_text("¿Qué cantidad se vendió?")
+    context.user_data['cliente'] = await asyncio.to_thread(
+        lambda: obtener_indice_clientes().canonico(update.message.text))
+    await update.message.reply_text("¿Qué cantidad se vendió?", reply_markup=ReplyKeyboardRemove())
     return AWAITING_CANTIDAD
 
+async def sugerir_clientes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Consulta inline - Autocompletar nombres de clientes desde el índice en memoria"""
+    sugerencias = await asyncio.to_thread(
+        lambda: obtener_indice_clientes().sugerencias(update.inline_query.query, limite=10))
+    
+    resultados = [
+        InlineQueryResultArticle(
+            id=str(i),
+            title=nombre,
+            description=f"{frecuencia} compras",
+            input_message_content=InputTextMessageContent(nombre)
+        )
+        for i, (nombre, frecuencia) in enumerate(sugerencias)
+    ]
+    
+    await update.inline_query.answer(resultados, cache_time=10, is_personal=True)
+
 async def recibir_cantidad(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Recibir cantidad"""
     try:
@@ -160,8 +879,6 @@ async def recibir_metodo_venta(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Guardar en Google Sheets
     try:
-        service = get_sheets_service()
-        
         fecha = datetime.now().strftime("%d/%m/%Y")
         valores = [[
             context.user_data['cliente'],
@@ -169,16 +886,14 @@ async def recibir_metodo_venta(update: Update, context: ContextTypes.DEFAULT_TYP
             context.user_data['cantidad'],
             context.user_data['valor'],
             context.user_data['deuda'],
-            metodo
+            metodo,
+            context.user_data['id']
         ]]
         
-        body = {'values': valores}
-        result = service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Ventas!A2',
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
+        # Si este ID ya se intentó guardar, la escritura fallida pudo haber llegado
+        reintento = context.user_data.get('id_intentado') == context.user_data['id']
+        context.user_data['id_intentado'] = context.user_data['id']
+        await asyncio.to_thread(lambda: agregar_filas(get_sheets_service(), 'ventas', valores, reintento))
         
         await update.message.reply_text(
             f"✅ *Venta registrada correctamente*\n\n"
@@ -193,10 +908,13 @@ async def recibir_metodo_venta(update: Update, context: ContextTypes.DEFAULT_TYP
         
     except Exception as e:
         logger.error(f"Error al guardar en Google Sheets: {e}")
+        # Se conserva el ID: reintentar no duplica el registro si la escritura sí llegó
         await update.message.reply_text(
-            f"❌ Error al guardar: {str(e)}",
-            reply_markup=ReplyKeyboardRemove()
+            f"❌ Error al guardar: {str(e)}\n\n"
+            "Selecciona el método de pago otra vez para reintentar o usa /cancel",
+            reply_markup=ReplyKeyboardMarkup([['Nequi', 'Efectivo']], resize_keyboard=True)
         )
+        return AWAITING_METODO_VENTA
     
     # Mostrar menú principal
     await start(update, context)
@@ -206,6 +924,8 @@ async def recibir_metodo_venta(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def agregar_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Iniciar el proceso de agregar un gasto"""
+    context.user_data['id'] = nuevo_id()
+    
     await update.message.reply_text(
         "📝 *Nuevo Registro de Gasto*\n\n"
         "¿Cuál es la descripción del gasto?",
@@ -213,10 +933,52 @@ async def agregar_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     )
     return AWAITING_GASTO
 
+def teclado_opciones(opciones, por_fila=2):
+    """Teclado con las opciones repartidas en filas"""
+    keyboard = [opciones[i:i + por_fila] for i in range(0, len(opciones), por_fila)]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
 async def recibir_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Recibir descripción del gasto"""
     context.user_data['gasto'] = update.message.text
-    await update.message.reply_text("¿Cuál es el costo?")
+    await update.message.reply_text(
+        "¿A qué categoría pertenece?",
+        reply_markup=teclado_opciones(list(CATEGORIAS_GASTO))
+    )
+    return AWAITING_CATEGORIA_GASTO
+
+async def recibir_categoria_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Recibir categoría del gasto"""
+    categoria = update.message.text
+    
+    if categoria not in CATEGORIAS_GASTO:
+        await update.message.reply_text(
+            "❌ Por favor, selecciona una de las categorías",
+            reply_markup=teclado_opciones(list(CATEGORIAS_GASTO))
+        )
+        return AWAITING_CATEGORIA_GASTO
+    
+    context.user_data['categoria'] = categoria
+    await update.message.reply_text(
+        "¿Y la subcategoría?",
+        reply_markup=teclado_opciones(CATEGORIAS_GASTO[categoria])
+    )
+    return AWAITING_SUBCATEGORIA_GASTO
+
+async def recibir_subcategoria_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Recibir subcategoría del gasto"""
+    subcategorias = CATEGORIAS_GASTO[context.user_data['categoria']]
+    subcategoria = update.message.text
+    
+    if subcategoria not in subcategorias:
+        await update.message.reply_text(
+            "❌ Por favor, selecciona una de las subcategorías",
+            reply_markup=teclado_opciones(subcategorias)
+        )
+        return AWAITING_SUBCATEGORIA_GASTO
+    
+    context.user_data['subcategoria'] = subcategoria
+    await update.message.reply_text("¿Cuál es el costo?", reply_markup=ReplyKeyboardRemove())
     return AWAITING_COSTO
 
 async def recibir_costo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -253,25 +1015,26 @@ async def recibir_metodo_gasto(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Guardar en Google Sheets
     try:
-        service = get_sheets_service()
-        
+        fecha = datetime.now().strftime("%d/%m/%Y")
         valores = [[
             context.user_data['gasto'],
             context.user_data['costo'],
-            metodo
+            metodo,
+            fecha,
+            context.user_data['categoria'],
+            context.user_data['subcategoria'],
+            context.user_data['id']
         ]]
         
-        body = {'values': valores}
-        result = service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Gastos!A2',
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
+        # Si este ID ya se intentó guardar, la escritura fallida pudo haber llegado
+        reintento = context.user_data.get('id_intentado') == context.user_data['id']
+        context.user_data['id_intentado'] = context.user_data['id']
+        await asyncio.to_thread(lambda: agregar_filas(get_sheets_service(), 'gastos', valores, reintento))
         
         await update.message.reply_text(
             f"✅ *Gasto registrado correctamente*\n\n"
             f"Gasto: {context.user_data['gasto']}\n"
+            f"Categoría: {context.user_data['categoria']} › {context.user_data['subcategoria']}\n"
             f"Costo: ${context.user_data['costo']}\n"
             f"Método: {metodo}",
             parse_mode='Markdown',
@@ -280,489 +1043,1364 @@ async def recibir_metodo_gasto(update: Update, context: ContextTypes.DEFAULT_TYP
         
     except Exception as e:
         logger.error(f"Error al guardar en Google Sheets: {e}")
+        # Se conserva el ID: reintentar no duplica el registro si la escritura sí llegó
         await update.message.reply_text(
-            f"❌ Error al guardar: {str(e)}",
-            reply_markup=ReplyKeyboardRemove()
+            f"❌ Error al guardar: {str(e)}\n\n"
+            "Selecciona el método de pago otra vez para reintentar o usa /cancel",
+            reply_markup=ReplyKeyboardMarkup([['Nequi', 'Efectivo']], resize_keyboard=True)
         )
+        return AWAITING_METODO_GASTO
     
     # Mostrar menú principal
     await start(update, context)
     return ConversationHandler.END
 
-# ============ VER TOTALES ============
+# ============ LÍMITE DE SOLICITUDES ============
 
-async def ver_total_ventas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Ver el total de ventas"""
-    try:
-        service = get_sheets_service()
-        
-        # Leer datos de la pestaña Ventas
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Ventas!A:F'
-        ).execute()
-        
-        rows = result.get('values', [])[1:]  # Saltar encabezado
-        
-        if not rows:
-            await update.message.reply_text("📊 No hay ventas registradas aún")
-            return
+# Segundos durante los que se ignora el mismo reporte repetido en un chat
+VENTANA_REPETICION = 2.0
+# Solicitudes seguidas permitidas por chat y solicitudes recuperadas por segundo
+CAPACIDAD_CHAT = 5
+RECARGA_CHAT = 0.5
+# Segundos entre dos limpiezas del estado por chat
+INTERVALO_PODA = 60.0
+
+class LimitadorChat:
+    """Cubeta de fichas por chat para frenar solicitudes abusivas"""
+    
+    def __init__(self, capacidad, recarga):
+        self.capacidad = capacidad
+        self.recarga = recarga
+        self.cubetas = {}  # chat_id -> (fichas, último instante)
+    
+    def permitir(self, chat_id):
+        ahora = time.monotonic()
+        fichas, ultimo = self.cubetas.get(chat_id, (self.capacidad, ahora))
+        fichas = min(self.capacidad, fichas + (ahora - ultimo) * self.recarga)
         
-        total_ventas = 0
-        nequi_total = 0
-        efectivo_total = 0
+        if fichas < 1:
+            self.cubetas[chat_id] = (fichas, ahora)
+            return False
         
-        for row in rows:
-            try:
-                valor = float(row[3]) if len(row) > 3 else 0
-                metodo = row[5] if len(row) > 5 else ""
-                
-                total_ventas += valor
-                
-                if metodo == "Nequi":
-                    nequi_total += valor
-                elif metodo == "Efectivo":
-                    efectivo_total += valor
-                    
-            except (ValueError, IndexError):
-                continue
+        self.cubetas[chat_id] = (fichas - 1, ahora)
+        return True
+    
+    def podar(self, ahora):
+        """Olvidar las cubetas que ya se recargaron por completo"""
+        self.cubetas = {
+            chat_id: (fichas, ultimo)
+            for chat_id, (fichas, ultimo) in self.cubetas.items()
+            if fichas + (ahora - ultimo) * self.recarga < self.capacidad
+        }
+
+class Coalescedor:
+    """Comparte el resultado de un cálculo en curso entre solicitudes iguales"""
+    
+    def __init__(self):
+        self.en_curso = {}  # nombre -> futuro
+    
+    async def ejecutar(self, nombre, funcion, executor=None):
+        futuro = self.en_curso.get(nombre)
         
-        mensaje = (
-            f"📊 *Total de Ventas*\n\n"
-            f"💰 Total: ${total_ventas:,.2f}\n"
-            f"📱 Nequi: ${nequi_total:,.2f}\n"
-            f"💵 Efectivo: ${efectivo_total:,.2f}\n"
-            f"📈 Registros: {len(rows)}"
-        )
+        if futuro is None:
+            # El cálculo corre en un hilo para no bloquear el bot
+            futuro = asyncio.get_running_loop().run_in_executor(executor, funcion)
+            self.en_curso[nombre] = futuro
+            futuro.add_done_callback(lambda _: self.en_curso.pop(nombre, None))
         
+        return await asyncio.shield(futuro)
+
+LIMITADOR = LimitadorChat(CAPACIDAD_CHAT, RECARGA_CHAT)
+COALESCEDOR = Coalescedor()
+
+reportes_en_curso = set()  # (chat_id, nombre)
+reportes_recientes = {}  # (chat_id, nombre) -> instante de la última respuesta
+chats_avisados = set()
+ultima_poda = 0.0
+
+def podar_solicitudes():
+    """Quitar el estado vencido para que no crezca con nombres de reporte arbitrarios"""
+    global ultima_poda
+    ahora = time.monotonic()
+    if ahora - ultima_poda < INTERVALO_PODA:
+        return
+    
+    vencidas = [clave for clave, instante in reportes_recientes.items() if ahora - instante >= VENTANA_REPETICION]
+    for clave in vencidas:
+        del reportes_recientes[clave]
+    
+    LIMITADOR.podar(ahora)
+    chats_avisados.intersection_update(LIMITADOR.cubetas)
+    ultima_poda = ahora
+
+async def admitir_solicitud(update: Update, nombre) -> bool:
+    """Decidir si se atiende una solicitud: descarta toques repetidos y limita cada chat"""
+    chat_id = update.effective_chat.id
+    clave = (chat_id, nombre)
+    podar_solicitudes()
+    
+    # Un toque repetido se resuelve con la respuesta que ya está en camino
+    if clave in reportes_en_curso:
+        return False
+    if time.monotonic() - reportes_recientes.get(clave, 0.0) < VENTANA_REPETICION:
+        return False
+    
+    if not LIMITADOR.permitir(chat_id):
+        if chat_id not in chats_avisados:
+            chats_avisados.add(chat_id)
+            await update.message.reply_text("⏳ Demasiadas solicitudes. Espera unos segundos")
+        return False
+    chats_avisados.discard(chat_id)
+    return True
+
+async def enviar_reporte(update: Update, context: ContextTypes.DEFAULT_TYPE, nombre, generar, mostrar_menu=False) -> None:
+    """Responder con un reporte, ignorando toques repetidos y limitando cada chat"""
+    if not await admitir_solicitud(update, nombre):
+        return
+    
+    clave = (update.effective_chat.id, nombre)
+    reportes_en_curso.add(clave)
+    try:
+        mensaje = await COALESCEDOR.ejecutar(nombre, generar)
         await update.message.reply_text(mensaje, parse_mode='Markdown')
-        
     except Exception as e:
-        logger.error(f"Error al leer ventas: {e}")
+        logger.error(f"Error al generar el reporte {nombre}: {e}")
         await update.message.reply_text(f"❌ Error al obtener datos: {str(e)}")
+    finally:
+        reportes_en_curso.discard(clave)
+        reportes_recientes[clave] = time.monotonic()
+    
+    if mostrar_menu:
+        await start(update, context)
 
-async def ver_total_gastos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Ver el total de gastos"""
-    try:
-        service = get_sheets_service()
-        
-        # Leer datos de la pestaña Gastos
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Gastos!A:C'
-        ).execute()
-        
-        rows = result.get('values', [])[1:]  # Saltar encabezado
-        
-        if not rows:
-            await update.message.reply_text("📉 No hay gastos registrados aún")
-            return
-        
-        total_gastos = 0
-        nequi_total = 0
-        efectivo_total = 0
+# ============ VER TOTALES ============
+
+def reporte_total_ventas():
+    """Calcular el total de ventas"""
+    # Leer datos de la pestaña Ventas desde la caché
+    ventas = obtener_registros('ventas')
+    
+    if not ventas:
+        return "📊 No hay ventas registradas aún"
+    
+    total_ventas = 0
+    nequi_total = 0
+    efectivo_total = 0
+    
+    for venta in ventas:
+        if venta.valor is None:
+            continue
         
-        for row in rows:
-            try:
-                costo = float(row[1]) if len(row) > 1 else 0
-                metodo = row[2] if len(row) > 2 else ""
-                
-                total_gastos += costo
-                
-                if metodo == "Nequi":
-                    nequi_total += costo
-                elif metodo == "Efectivo":
-                    efectivo_total += costo
-                    
-            except (ValueError, IndexError):
-                continue
+        total_ventas += venta.valor
         
-        mensaje = (
-            f"📉 *Total de Gastos*\n\n"
-            f"💰 Total: ${total_gastos:,.2f}\n"
-            f"📱 Nequi: ${nequi_total:,.2f}\n"
-            f"💵 Efectivo: ${efectivo_total:,.2f}\n"
-            f"📈 Registros: {len(rows)}"
-        )
+        if venta.metodo == "Nequi":
+            nequi_total += venta.valor
+        elif venta.metodo == "Efectivo":
+            efectivo_total += venta.valor
+    
+    mensaje = (
+        f"📊 *Total de Ventas*\n\n"
+        f"💰 Total: ${total_ventas:,.2f}\n"
+        f"📱 Nequi: ${nequi_total:,.2f}\n"
+        f"💵 Efectivo: ${efectivo_total:,.2f}\n"
+        f"📈 Registros: {len(ventas)}"
+    )
+    
+    return mensaje
+
+async def ver_total_ventas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ver el total de ventas"""
+    await enviar_reporte(update, context, 'total_ventas', reporte_total_ventas)
+
+def reporte_total_gastos():
+    """Calcular el total de gastos"""
+    # Leer datos de la pestaña Gastos desde la caché
+    gastos = obtener_registros('gastos')
+    
+    if not gastos:
+        return "📉 No hay gastos registrados aún"
+    
+    total_gastos = 0
+    nequi_total = 0
+    efectivo_total = 0
+    
+    for gasto in gastos:
+        if gasto.costo is None:
+            continue
         
-        await update.message.reply_text(mensaje, parse_mode='Markdown')
+        total_gastos += gasto.costo
         
-    except Exception as e:
-        logger.error(f"Error al leer gastos: {e}")
-        await update.message.reply_text(f"❌ Error al obtener datos: {str(e)}")
+        if gasto.metodo == "Nequi":
+            nequi_total += gasto.costo
+        elif gasto.metodo == "Efectivo":
+            efectivo_total += gasto.costo
+    
+    mensaje = (
+        f"📉 *Total de Gastos*\n\n"
+        f"💰 Total: ${total_gastos:,.2f}\n"
+        f"📱 Nequi: ${nequi_total:,.2f}\n"
+        f"💵 Efectivo: ${efectivo_total:,.2f}\n"
+        f"📈 Registros: {len(gastos)}"
+    )
+    
+    return mensaje
+
+async def ver_total_gastos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ver el total de gastos"""
+    await enviar_reporte(update, context, 'total_gastos', reporte_total_gastos)
+
+def reporte_balance():
+    """Calcular el balance (ganancias - gastos)"""
+    # Leer ventas y gastos desde la caché
+    ventas = obtener_registros('ventas')
+    gastos = obtener_registros('gastos')
+    
+    # Calcular totales, ignorando valores inválidos
+    total_ventas = sum(venta.valor for venta in ventas if venta.valor is not None)
+    total_gastos = sum(gasto.costo for gasto in gastos if gasto.costo is not None)
+    
+    balance = total_ventas - total_gastos
+    emoji = "📈" if balance >= 0 else "📉"
+    
+    mensaje = (
+        f"{emoji} *Balance General*\n\n"
+        f"📊 Ventas Totales: ${total_ventas:,.2f}\n"
+        f"📉 Gastos Totales: ${total_gastos:,.2f}\n"
+        f"💰 *Balance: ${balance:,.2f}*"
+    )
+    
+    return mensaje
 
 async def ver_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Ver el balance (ganancias - gastos)"""
-    try:
-        service = get_sheets_service()
-        
-        # Leer ventas
-        result_ventas = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Ventas!A:F'
-        ).execute()
-        
-        # Leer gastos
-        result_gastos = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Gastos!A:C'
-        ).execute()
-        
-        rows_ventas = result_ventas.get('values', [])[1:]
-        rows_gastos = result_gastos.get('values', [])[1:]
-        
-        total_ventas = 0
-        total_gastos = 0
-        
-        # Calcular total de ventas
-        for row in rows_ventas:
-            try:
-                valor = float(row[3]) if len(row) > 3 else 0
-                total_ventas += valor
-            except (ValueError, IndexError):
-                continue
-        
-        # Calcular total de gastos
-        for row in rows_gastos:
-            try:
-                costo = float(row[1]) if len(row) > 1 else 0
-                total_gastos += costo
-            except (ValueError, IndexError):
-                continue
+    await enviar_reporte(update, context, 'balance', reporte_balance)
+
+# ============ VER RESUMEN POR CLIENTES ============
+
+def reporte_resumen_clientes():
+    """Construir el resumen de todos los clientes"""
+    # Leer datos de la pestaña Ventas desde la caché
+    ventas = obtener_registros('ventas')
+    
+    if not ventas:
+        return "📊 No hay ventas registradas aún"
+    
+    # Agrupar por cliente, unificando variantes del mismo nombre
+    indice = obtener_indice_clientes()
+    clientes = {}
+    
+    for venta in ventas:
+        if venta.cantidad is None or venta.valor is None:
+            continue
         
-        balance = total_ventas - total_gastos
-        emoji = "📈" if balance >= 0 else "📉"
+        cliente = venta.cliente or "Desconocido"
+        clave = clave_cliente(cliente)
+        if clave in indice.clientes:
+            cliente = indice.nombre(clave)
         
-        mensaje = (
-            f"{emoji} *Balance General*\n\n"
-            f"📊 Ventas Totales: ${total_ventas:,.2f}\n"
-            f"📉 Gastos Totales: ${total_gastos:,.2f}\n"
-            f"💰 *Balance: ${balance:,.2f}*"
-        )
+        if cliente not in clientes:
+            clientes[cliente] = {'cantidad': 0, 'valor': 0, 'transacciones': 0}
         
-        await update.message.reply_text(mensaje, parse_mode='Markdown')
+        clientes[cliente]['cantidad'] += venta.cantidad
+        clientes[cliente]['valor'] += venta.valor
+        clientes[cliente]['transacciones'] += 1
+    
+    if not clientes:
+        return "📊 No hay datos de clientes"
+    
+    # Crear tabla
+    tabla = "👥 *RESUMEN DE CLIENTES*\n\n"
+    tabla += "```"
+    tabla += f"{'Cliente':<20} {'Cantidad':<12} {'Total $':<15} {'Trans.':<6}\n"
+    tabla += "─" * 53 + "\n"
+    
+    total_cantidad = 0
+    total_valor = 0
+    total_trans = 0
+    
+    for cliente in sorted(clientes.keys()):
+        datos = clientes[cliente]
+        tabla += f"{cliente:<20} {datos['cantidad']:>11.2f} ${datos['valor']:>13,.2f} {datos['transacciones']:>5}\n"
         
-    except Exception as e:
-        logger.error(f"Error al calcular balance: {e}")
-        await update.message.reply_text(f"❌ Error al obtener datos: {str(e)}")
-
-# ============ VER RESUMEN POR CLIENTES ============
+        total_cantidad += datos['cantidad']
+        total_valor += datos['valor']
+        total_trans += datos['transacciones']
+    
+    tabla += "─" * 53 + "\n"
+    tabla += f"{'TOTAL':<20} {total_cantidad:>11.2f} ${total_valor:>13,.2f} {total_trans:>5}\n"
+    tabla += "```"
+    
+    tabla += f"\n*Para ver detalles de un cliente usa: /cliente nombre*"
+    
+    return tabla
 
 async def ver_resumen_clientes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Ver resumen de todos los clientes"""
-    try:
-        service = get_sheets_service()
-        
-        # Leer datos de la pestaña Ventas
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Ventas!A:F'
-        ).execute()
-        
-        rows = result.get('values', [])[1:]  # Saltar encabezado
-        
-        if not rows:
-            await update.message.reply_text("📊 No hay ventas registradas aún")
-            return
+    await enviar_reporte(update, context, 'resumen_clientes', reporte_resumen_clientes)
+
+# ============ VER DETALLES DE UN CLIENTE ============
+
+def reporte_cliente_detalle(nombre_cliente):
+    """Construir el detalle de las ventas de un cliente"""
+    # Leer datos de Ventas desde la caché
+    ventas = obtener_registros('ventas')
+    
+    # Filtrar por cliente
+    clave = clave_cliente(nombre_cliente)
+    transacciones = []
+    total_cantidad = 0
+    total_valor = 0
+    total_deuda = 0
+    
+    for venta in ventas:
+        if clave_cliente(venta.cliente) != clave:
+            continue
+        if venta.cantidad is None or venta.valor is None or venta.deuda is None:
+            continue
         
-        # Agrupar por cliente
-        clientes = {}
+        transacciones.append(venta)
         
-        for row in rows:
-            try:
-                cliente = row[0] if len(row) > 0 else "Desconocido"
-                cantidad = float(row[2]) if len(row) > 2 else 0
-                valor = float(row[3]) if len(row) > 3 else 0
-                
-                if cliente not in clientes:
-                    clientes[cliente] = {'cantidad': 0, 'valor': 0, 'transacciones': 0}
-                
-                clientes[cliente]['cantidad'] += cantidad
-                clientes[cliente]['valor'] += valor
-                clientes[cliente]['transacciones'] += 1
-                
-            except (ValueError, IndexError):
-                continue
+        total_cantidad += venta.cantidad
+        total_valor += venta.valor
+        total_deuda += venta.deuda
+    
+    if not transacciones:
+        return f"❌ No hay ventas registradas para: *{nombre_cliente}*"
+    
+    # Crear reporte detallado
+    reporte = f"👤 *DETALLES DE {nombre_cliente.upper()}*\n\n"
+    reporte += "```"
+    reporte += f"{'Fecha':<12} {'Cantidad':<12} {'Valor':<14} {'Deuda':<12} {'Método':<10}\n"
+    reporte += "─" * 60 + "\n"
+    
+    for venta in transacciones:
+        reporte += f"{venta.fecha or 'N/A':<12} {venta.cantidad:>11.2f} ${venta.valor:>12,.2f} ${venta.deuda:>10,.2f} {venta.metodo or 'N/A':<10}\n"
+    
+    reporte += "─" * 60 + "\n"
+    reporte += f"{'TOTAL':<12} {total_cantidad:>11.2f} ${total_valor:>12,.2f} ${total_deuda:>10,.2f}\n"
+    reporte += "```"
+    
+    # Agregar resumen
+    reporte += f"\n📊 *Información del Cliente:*\n"
+    reporte += f"• Transacciones: {len(transacciones)}\n"
+    reporte += f"• Cantidad Total: {total_cantidad:,.2f}\n"
+    reporte += f"• Valor Total: ${total_valor:,.2f}\n"
+    reporte += f"• Deuda Pendiente: ${total_deuda:,.2f}"
+    
+    return reporte
+
+async def ver_cliente_detalle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ver detalles completos de un cliente específico"""
+    if not context.args:
+        await update.message.reply_text(
+            "❌ *Uso:* `/cliente nombre`\n\n"
+            "*Ejemplo:* `/cliente Santiago`",
+            parse_mode='Markdown'
+        )
+        return
+    
+    nombre_cliente = " ".join(context.args)
+    await enviar_reporte(
+        update, context, f"cliente:{clave_cliente(nombre_cliente)}",
+        lambda: reporte_cliente_detalle(nombre_cliente)
+    )
+
+# ============ VER RESUMEN DE GASTOS (NUEVO) ============
+
+def reporte_resumen_gastos():
+    """Construir el resumen de gastos agrupados por descripción"""
+    # Leer datos de la pestaña Gastos desde la caché
+    registros = obtener_registros('gastos')
+    
+    if not registros:
+        return "📉 No hay gastos registrados aún"
+    
+    # Agrupar por descripción de gasto
+    gastos = {}
+    
+    for gasto in registros:
+        if gasto.costo is None:
+            continue
         
-        if not clientes:
-            await update.message.reply_text("📊 No hay datos de clientes")
-            return
+        descripcion = gasto.descripcion or "Desconocido"
         
-        # Crear tabla
-        tabla = "👥 *RESUMEN DE CLIENTES*\n\n"
-        tabla += "```"
-        tabla += f"{'Cliente':<20} {'Cantidad':<12} {'Total $':<15} {'Trans.':<6}\n"
-        tabla += "─" * 53 + "\n"
+        if descripcion not in gastos:
+            gastos[descripcion] = {'costo': 0, 'cantidad': 0, 'nequi': 0, 'efectivo': 0}
         
-        total_cantidad = 0
-        total_valor = 0
-        total_trans = 0
+        gastos[descripcion]['costo'] += gasto.costo
+        gastos[descripcion]['cantidad'] += 1
         
-        for cliente in sorted(clientes.keys()):
-            datos = clientes[cliente]
-            tabla += f"{cliente:<20} {datos['cantidad']:>11.2f} ${datos['valor']:>13,.2f} {datos['transacciones']:>5}\n"
-            
-            total_cantidad += datos['cantidad']
-            total_valor += datos['valor']
-            total_trans += datos['transacciones']
+        if gasto.metodo == "Nequi":
+            gastos[descripcion]['nequi'] += gasto.costo
+        elif gasto.metodo == "Efectivo":
+            gastos[descripcion]['efectivo'] += gasto.costo
+    
+    if not gastos:
+        return "📉 No hay datos de gastos"
+    
+    # Crear tabla
+    tabla = "💸 *RESUMEN DE GASTOS*\n\n"
+    tabla += "```"
+    tabla += f"{'Descripción':<20} {'Cantidad':<10} {'Total $':<15}\n"
+    tabla += "─" * 45 + "\n"
+    
+    total_gastos = 0
+    total_cantidad = 0
+    
+    for desc in sorted(gastos.keys()):
+        datos = gastos[desc]
+        tabla += f"{desc:<20} {datos['cantidad']:>9} ${datos['costo']:>13,.2f}\n"
         
-        tabla += "─" * 53 + "\n"
-        tabla += f"{'TOTAL':<20} {total_cantidad:>11.2f} ${total_valor:>13,.2f} {total_trans:>5}\n"
-        tabla += "```"
+        total_gastos += datos['costo']
+        total_cantidad += datos['cantidad']
+    
+    tabla += "─" * 45 + "\n"
+    tabla += f"{'TOTAL':<20} {total_cantidad:>9} ${total_gastos:>13,.2f}\n"
+    tabla += "```"
+    
+    tabla += f"\n*Para ver detalles de un gasto usa: /gasto descripción*"
+    
+    return tabla
+
+async def ver_resumen_gastos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ver resumen de todos los gastos agrupados por descripción"""
+    await enviar_reporte(update, context, 'resumen_gastos', reporte_resumen_gastos)
+
+# ============ VER DETALLES DE UN GASTO (NUEVO) ============
+
+def reporte_gasto_detalle(descripcion_gasto):
+    """Construir el detalle de los registros de un gasto"""
+    # Leer datos de Gastos desde la caché
+    gastos = obtener_registros('gastos')
+    
+    # Filtrar por descripción
+    registros = []
+    total_costo = 0
+    nequi_total = 0
+    efectivo_total = 0
+    
+    for numero, gasto in enumerate(gastos, 1):
+        if gasto.descripcion.lower() != descripcion_gasto.lower() or gasto.costo is None:
+            continue
         
-        tabla += f"\n*Para ver detalles de un cliente usa: /cliente nombre*"
+        registros.append((numero, gasto))
         
-        await update.message.reply_text(tabla, parse_mode='Markdown')
+        total_costo += gasto.costo
         
-    except Exception as e:
-        logger.error(f"Error al leer clientes: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
-
-# ============ VER DETALLES DE UN CLIENTE ============
+        if gasto.metodo == "Nequi":
+            nequi_total += gasto.costo
+        elif gasto.metodo == "Efectivo":
+            efectivo_total += gasto.costo
+    
+    if not registros:
+        return f"❌ No hay gastos registrados para: *{descripcion_gasto}*"
+    
+    # Crear reporte detallado
+    reporte = f"💰 *DETALLES DE GASTO: {descripcion_gasto.upper()}*\n\n"
+    reporte += "```"
+    reporte += f"{'#':<4} {'Costo':<15} {'Método':<12}\n"
+    reporte += "─" * 31 + "\n"
+    
+    for numero, gasto in registros:
+        reporte += f"{numero:<4} ${gasto.costo:>13,.2f} {gasto.metodo or 'N/A':<12}\n"
+    
+    reporte += "─" * 31 + "\n"
+    reporte += f"{'TOTAL':<4} ${total_costo:>13,.2f}\n"
+    reporte += "```"
+    
+    # Agregar resumen
+    reporte += f"\n📊 *Información del Gasto:*\n"
+    reporte += f"• Registros: {len(registros)}\n"
+    reporte += f"• Costo Total: ${total_costo:,.2f}\n"
+    reporte += f"• Nequi: ${nequi_total:,.2f}\n"
+    reporte += f"• Efectivo: ${efectivo_total:,.2f}"
+    
+    return reporte
 
-async def ver_cliente_detalle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Ver detalles completos de un cliente específico"""
+async def ver_gasto_detalle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ver detalles completos de un gasto específico"""
     if not context.args:
         await update.message.reply_text(
-            "❌ *Uso:* `/cliente nombre`\n\n"
-            "*Ejemplo:* `/cliente Santiago`",
+            "❌ *Uso:* `/gasto descripción`\n\n"
+            "*Ejemplo:* `/gasto Arriendo`",
             parse_mode='Markdown'
         )
         return
     
-    nombre_cliente = " ".join(context.args)
+    descripcion_gasto = " ".join(context.args)
+    await enviar_reporte(
+        update, context, f"gasto:{descripcion_gasto.lower()}",
+        lambda: reporte_gasto_detalle(descripcion_gasto)
+    )
+
+# ============ GASTOS POR CATEGORÍA ============
+
+MESES = ['Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio',
+         'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre']
+
+class NodoGastos:
+    """Nodo del árbol de gastos con su total general y por mes"""
+    __slots__ = ('total', 'registros', 'por_mes', 'hijos')
     
-    try:
-        service = get_sheets_service()
+    def __init__(self):
+        self.total = 0.0
+        self.registros = 0
+        self.por_mes = {}  # 'aaaa-mm' -> [total, registros]
+        self.hijos = {}
+    
+    def hijo(self, nombre):
+        nodo = self.hijos.get(nombre)
+        if nodo is None:
+            nodo = self.hijos[nombre] = NodoGastos()
+        return nodo
+    
+    def acumular(self, mes, costo):
+        self.total += costo
+        self.registros += 1
+        if mes:
+            acumulado = self.por_mes.setdefault(mes, [0.0, 0])
+            acumulado[0] += costo
+            acumulado[1] += 1
+    
+    def totales(self, mes=None):
+        """Total y número de registros de todo el historial o de un mes"""
+        if mes is None:
+            return self.total, self.registros
+        total, registros = self.por_mes.get(mes, (0.0, 0))
+        return total, registros
+
+class IndiceGastos(IndiceIncremental):
+    """Árbol categoría › subcategoría con los totales precalculados"""
+    
+    def reiniciar(self):
+        self.raiz = NodoGastos()
+        self.por_dia = {}  # fecha -> costo total
+    
+    def agregar(self, gasto):
+        if gasto.costo is None:
+            return
         
-        # Leer datos de Ventas
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Ventas!A:F'
-        ).execute()
+        fecha = parsear_fecha(gasto.fecha)
+        mes = fecha.strftime("%Y-%m") if fecha else None
+        if fecha:
+            self.por_dia[fecha] = self.por_dia.get(fecha, 0.0) + gasto.costo
+        categoria = self.raiz.hijo(gasto.categoria or "Sin categoría")
+        subcategoria = categoria.hijo(gasto.subcategoria or "Sin subcategoría")
         
-        rows = result.get('values', [])[1:]  # Saltar encabezado
+        for nodo in (self.raiz, categoria, subcategoria):
+            nodo.acumular(mes, gasto.costo)
+    
+    def costo_entre(self, inicio, fin):
+        """Costo total de los gastos entre dos fechas, incluidas"""
+        dias = (fin - inicio).days + 1
+        return sum(self.por_dia.get(inicio + timedelta(days=i), 0.0) for i in range(dias))
+
+INDICE_GASTOS = IndiceGastos('gastos')
+
+def parsear_periodo(texto):
+    """Convertir 'mes', 'todo' o 'aaaa-mm' en la clave de mes (None = todo el historial)"""
+    texto = texto.lower()
+    if texto == 'todo':
+        return None
+    if texto == 'mes':
+        return datetime.now().strftime("%Y-%m")
+    # Normalizar '2024-1' a '2024-01' (ValueError si no es un periodo)
+    return datetime.strptime(texto, "%Y-%m").strftime("%Y-%m")
+
+def nombre_periodo(mes):
+    if mes is None:
+        return "Todo el historial"
+    anio, numero = mes.split('-')
+    return f"{MESES[int(numero) - 1]} {anio}"
+
+def reporte_categorias(categoria=None, mes=None):
+    """Construir el resumen de gastos por categoría y subcategoría de un periodo"""
+    obtener_registros('gastos')
+    INDICE_GASTOS.sincronizar()
+    
+    with INDICE_GASTOS.lock:
+        raiz = INDICE_GASTOS.raiz
+        categorias = raiz.hijos
+        
+        if categoria is not None:
+            categorias = {
+                nombre: nodo for nombre, nodo in categorias.items()
+                if nombre.lower() == categoria.lower()
+            }
+            if not categorias:
+                return f"❌ No hay gastos en la categoría: *{categoria}*"
+        
+        tabla = f"📂 *GASTOS POR CATEGORÍA*\n_{nombre_periodo(mes)}_\n\n"
+        tabla += "```"
+        tabla += f"{'Categoría':<22} {'Reg.':>5} {'Total $':>14}\n"
+        tabla += "─" * 43 + "\n"
         
-        # Filtrar por cliente
-        transacciones = []
-        total_cantidad = 0
-        total_valor = 0
-        total_deuda = 0
+        total_periodo = 0
+        registros_periodo = 0
         
-        for row in rows:
-            try:
-                cliente = row[0] if len(row) > 0 else ""
-                
-                if cliente.lower() == nombre_cliente.lower():
-                    fecha = row[1] if len(row) > 1 else "N/A"
-                    cantidad = float(row[2]) if len(row) > 2 else 0
-                    valor = float(row[3]) if len(row) > 3 else 0
-                    deuda = float(row[4]) if len(row) > 4 else 0
-                    metodo = row[5] if len(row) > 5 else "N/A"
-                    
-                    transacciones.append({
-                        'fecha': fecha,
-                        'cantidad': cantidad,
-                        'valor': valor,
-                        'deuda': deuda,
-                        'metodo': metodo
-                    })
-                    
-                    total_cantidad += cantidad
-                    total_valor += valor
-                    total_deuda += deuda
-                    
-            except (ValueError, IndexError):
+        for nombre in sorted(categorias):
+            nodo = categorias[nombre]
+            total, registros = nodo.totales(mes)
+            if not registros:
                 continue
+            
+            tabla += f"{nombre:<22} {registros:>5} ${total:>13,.2f}\n"
+            for sub in sorted(nodo.hijos):
+                sub_total, sub_registros = nodo.hijos[sub].totales(mes)
+                if sub_registros:
+                    tabla += f"  {sub:<20} {sub_registros:>5} ${sub_total:>13,.2f}\n"
+            
+            total_periodo += total
+            registros_periodo += registros
         
-        if not transacciones:
-            await update.message.reply_text(f"❌ No hay ventas registradas para: *{nombre_cliente}*", parse_mode='Markdown')
+        tabla += "─" * 43 + "\n"
+        tabla += f"{'TOTAL':<22} {registros_periodo:>5} ${total_periodo:>13,.2f}\n"
+        tabla += "```"
+    
+    if not registros_periodo:
+        return f"📂 No hay gastos registrados en: *{nombre_periodo(mes)}*"
+    
+    tabla += "\n*Uso: /categorias [categoría] [mes|todo|aaaa-mm]*"
+    return tabla
+
+async def ver_categorias(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ver gastos por categoría de un periodo (por defecto el mes actual)"""
+    args = list(context.args)
+    mes = parsear_periodo('mes')
+    
+    if args:
+        try:
+            mes = parsear_periodo(args[-1])
+            args.pop()
+        except ValueError:
+            pass
+    
+    categoria = " ".join(args) or None
+    await enviar_reporte(
+        update, context,
+        f"categorias:{categoria}:{mes}",
+        lambda: reporte_categorias(categoria, mes)
+    )
+
+# ============ ANALÍTICA DE VENTAS ============
+
+# Ventanas (en días) que se mantienen precalculadas
+VENTANAS_ANALITICA = (7, 30, 90)
+# Clientes que se muestran en el top de la analítica
+TOP_CLIENTES = 5
+
+class AcumuladoVentas:
+    """Totales de un conjunto de ventas, también por cliente"""
+    __slots__ = ('valor', 'cantidad', 'ventas', 'clientes')
+    
+    def __init__(self):
+        self.valor = 0.0
+        self.cantidad = 0.0
+        self.ventas = 0
+        self.clientes = {}  # clave -> [valor, cantidad, ventas]
+    
+    def agregar(self, clave, cantidad, valor, ventas=1):
+        self.valor += valor
+        self.cantidad += cantidad
+        self.ventas += ventas
+        
+        cliente = self.clientes.setdefault(clave, [0.0, 0.0, 0])
+        cliente[0] += valor
+        cliente[1] += cantidad
+        cliente[2] += ventas
+        if cliente[2] == 0:
+            del self.clientes[clave]
+    
+    def sumar(self, otro, signo=1):
+        """Sumar (o restar con signo=-1) otro acumulado"""
+        for clave, (valor, cantidad, ventas) in list(otro.clientes.items()):
+            self.agregar(clave, signo * cantidad, signo * valor, signo * ventas)
+
+class VentanaDeslizante:
+    """Acumulado de los últimos N días que avanza sumando y restando días completos"""
+    
+    def __init__(self, dias):
+        self.dias = dias
+        self.fin = None  # Último día incluido
+        self.acumulado = AcumuladoVentas()
+    
+    def contiene(self, fecha):
+        return self.fin is not None and self.fin - timedelta(days=self.dias - 1) <= fecha <= self.fin
+    
+    def mover(self, hoy, por_dia):
+        """Dejar la ventana terminando en hoy"""
+        if self.fin == hoy:
             return
         
-        # Crear reporte detallado
-        reporte = f"👤 *DETALLES DE {nombre_cliente.upper()}*\n\n"
-        reporte += "```"
-        reporte += f"{'Fecha':<12} {'Cantidad':<12} {'Valor':<14} {'Deuda':<12} {'Método':<10}\n"
-        reporte += "─" * 60 + "\n"
+        if self.fin is None or hoy < self.fin or (hoy - self.fin).days >= self.dias:
+            # No hay días en común: recalcular la ventana
+            self.acumulado = AcumuladoVentas()
+            for i in range(self.dias):
+                dia = por_dia.get(hoy - timedelta(days=i))
+                if dia:
+                    self.acumulado.sumar(dia)
+        else:
+            for i in range(1, (hoy - self.fin).days + 1):
+                sale = por_dia.get(self.fin - timedelta(days=self.dias - i))
+                entra = por_dia.get(self.fin + timedelta(days=i))
+                if sale:
+                    self.acumulado.sumar(sale, -1)
+                if entra:
+                    self.acumulado.sumar(entra)
+        
+        self.fin = hoy
+
+class MotorAnalitica(IndiceIncremental):
+    """Agregados de ventas por cliente, día, mes y ventanas deslizantes"""
+    
+    def reiniciar(self):
+        self.por_dia = {}  # fecha -> AcumuladoVentas
+        self.por_mes = {}  # 'aaaa-mm' -> AcumuladoVentas
+        self.ventanas = {dias: VentanaDeslizante(dias) for dias in VENTANAS_ANALITICA}
+    
+    def agregar(self, venta):
+        if venta.cantidad is None or venta.valor is None or not venta.cliente.strip():
+            return
         
-        for trans in transacciones:
-            reporte += f"{str(trans['fecha']):<12} {trans['cantidad']:>11.2f} ${trans['valor']:>12,.2f} ${trans['deuda']:>10,.2f} {str(trans['metodo']):<10}\n"
+        fecha = parsear_fecha(venta.fecha)
+        if fecha is None:
+            return
         
-        reporte += "─" * 60 + "\n"
-        reporte += f"{'TOTAL':<12} {total_cantidad:>11.2f} ${total_valor:>12,.2f} ${total_deuda:>10,.2f}\n"
-        reporte += "```"
+        clave = clave_cliente(venta.cliente)
         
-        # Agregar resumen
-        reporte += f"\n📊 *Información del Cliente:*\n"
-        reporte += f"• Transacciones: {len(transacciones)}\n"
-        reporte += f"• Cantidad Total: {total_cantidad:,.2f}\n"
-        reporte += f"• Valor Total: ${total_valor:,.2f}\n"
-        reporte += f"• Deuda Pendiente: ${total_deuda:,.2f}"
+        if fecha not in self.por_dia:
+            self.por_dia[fecha] = AcumuladoVentas()
+        self.por_dia[fecha].agregar(clave, venta.cantidad, venta.valor)
         
-        await update.message.reply_text(reporte, parse_mode='Markdown')
+        mes = fecha.strftime("%Y-%m")
+        if mes not in self.por_mes:
+            self.por_mes[mes] = AcumuladoVentas()
+        self.por_mes[mes].agregar(clave, venta.cantidad, venta.valor)
         
-    except Exception as e:
-        logger.error(f"Error al leer cliente: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
+        # Las ventanas que ya cubren esta fecha se actualizan en el acto
+        for ventana in self.ventanas.values():
+            if ventana.contiene(fecha):
+                ventana.acumulado.agregar(clave, venta.cantidad, venta.valor)
+    
+    def ventana(self, dias, hoy):
+        """Acumulado de los últimos días terminando en hoy"""
+        ventana = self.ventanas[dias]
+        ventana.mover(hoy, self.por_dia)
+        return ventana.acumulado
+    
+    def valor_entre(self, inicio, fin):
+        """Ingresos de las ventas entre dos fechas, incluidas"""
+        dias = (fin - inicio).days + 1
+        total = 0.0
+        for i in range(dias):
+            dia = self.por_dia.get(inicio + timedelta(days=i))
+            if dia:
+                total += dia.valor
+        return total
 
-# ============ VER RESUMEN DE GASTOS (NUEVO) ============
+MOTOR_ANALITICA = MotorAnalitica('ventas')
 
-async def ver_resumen_gastos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Ver resumen de todos los gastos agrupados por descripción"""
-    try:
-        service = get_sheets_service()
+def ultimos_meses(hoy, cantidad):
+    """Claves 'aaaa-mm' de los últimos meses, terminando en el mes de hoy"""
+    meses = []
+    anio, mes = hoy.year, hoy.month
+    for _ in range(cantidad):
+        meses.append(f"{anio}-{mes:02d}")
+        anio, mes = (anio, mes - 1) if mes > 1 else (anio - 1, 12)
+    return meses[::-1]
+
+def crecimiento(actual, anterior):
+    """Variación porcentual entre dos valores"""
+    if not anterior:
+        return "—"
+    return f"{(actual - anterior) / anterior * 100:+.1f}%"
+
+def reporte_analitica(dias):
+    """Construir el reporte de analítica de ventas y utilidad de los últimos días"""
+    obtener_registros('ventas')
+    indice = obtener_indice_clientes()
+    MOTOR_ANALITICA.sincronizar()
+    INDICE_GASTOS.sincronizar()
+    
+    hoy = datetime.now().date()
+    
+    with MOTOR_ANALITICA.lock, INDICE_GASTOS.lock:
+        ventana = MOTOR_ANALITICA.ventana(dias, hoy)
         
-        # Leer datos de la pestaña Gastos
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='Gastos!A:C'
-        ).execute()
+        if not ventana.ventas:
+            return f"📈 No hay ventas en los últimos {dias} días"
         
-        rows = result.get('values', [])[1:]  # Saltar encabezado
+        reporte = f"📈 *ANALÍTICA DE VENTAS*\n_Últimos {dias} días_\n\n"
         
-        if not rows:
-            await update.message.reply_text("📉 No hay gastos registrados aún")
-            return
+        # Velocidad de ventas
+        reporte += f"💰 Ingresos: ${ventana.valor:,.2f}\n"
+        reporte += f"🧾 Ventas: {ventana.ventas} ({ventana.ventas / dias:.2f} por día)\n"
+        reporte += f"📦 Unidades: {ventana.cantidad:,.2f} ({ventana.cantidad / dias:.2f} por día)\n"
+        if ventana.cantidad:
+            reporte += f"🏷️ Precio unitario promedio: ${ventana.valor / ventana.cantidad:,.2f}\n"
         
-        # Agrupar por descripción de gasto
-        gastos = {}
+        # Utilidad de la ventana con los gastos de los mismos días
+        costo = INDICE_GASTOS.costo_entre(hoy - timedelta(days=dias - 1), hoy)
+        utilidad = ventana.valor - costo
+        reporte += f"💸 Gastos: ${costo:,.2f}\n"
+        reporte += f"📊 Utilidad: ${utilidad:,.2f}"
+        reporte += f" (margen {utilidad / ventana.valor * 100:.1f}%)\n" if ventana.valor else "\n"
         
-        for row in rows:
-            try:
-                descripcion = row[0] if len(row) > 0 else "Desconocido"
-                costo = float(row[1]) if len(row) > 1 else 0
-                metodo = row[2] if len(row) > 2 else "N/A"
-                
-                if descripcion not in gastos:
-                    gastos[descripcion] = {'costo': 0, 'cantidad': 0, 'nequi': 0, 'efectivo': 0}
-                
-                gastos[descripcion]['costo'] += costo
-                gastos[descripcion]['cantidad'] += 1
-                
-                if metodo == "Nequi":
-                    gastos[descripcion]['nequi'] += costo
-                elif metodo == "Efectivo":
-                    gastos[descripcion]['efectivo'] += costo
-                
-            except (ValueError, IndexError):
-                continue
+        # Mejores clientes por ingresos y su precio unitario promedio
+        mejores = heapq.nlargest(TOP_CLIENTES, ventana.clientes.items(), key=lambda item: item[1][0])
         
-        if not gastos:
-            await update.message.reply_text("📉 No hay datos de gastos")
-            return
+        reporte += f"\n👑 *Top {len(mejores)} clientes*\n"
+        reporte += "```"
+        reporte += f"{'Cliente':<16} {'Total $':>12} {'$/Unidad':>10} {'%':>6}\n"
+        reporte += "─" * 47 + "\n"
         
-        # Crear tabla
-        tabla = "💸 *RESUMEN DE GASTOS*\n\n"
-        tabla += "```"
-        tabla += f"{'Descripción':<20} {'Cantidad':<10} {'Total $':<15}\n"
-        tabla += "─" * 45 + "\n"
+        for clave, (valor, cantidad, ventas) in mejores:
+            nombre = indice.nombre(clave) if clave in indice.clientes else clave
+            unitario = f"{valor / cantidad:,.2f}" if cantidad else "—"
+            participacion = valor / ventana.valor * 100 if ventana.valor else 0
+            reporte += f"{nombre[:16]:<16} ${valor:>11,.2f} {unitario:>10} {participacion:>5.1f}%\n"
         
-        total_gastos = 0
-        total_cantidad = 0
+        reporte += "```\n"
         
-        for desc in sorted(gastos.keys()):
-            datos = gastos[desc]
-            tabla += f"{desc:<20} {datos['cantidad']:>9} ${datos['costo']:>13,.2f}\n"
+        # Crecimiento mes a mes (los meses sin ventas cuentan como 0). El mes en curso
+        # se compara con los mismos días del mes anterior para no mostrar caídas falsas
+        reporte += "\n📅 *Mes a mes*\n"
+        reporte += "```"
+        reporte += f"{'Mes':<9} {'Ventas $':>12} {'Utilidad $':>12} {'Var.':>7}\n"
+        reporte += "─" * 43 + "\n"
+        
+        meses = ultimos_meses(hoy, 5)
+        mes_actual = meses[-1]
+        inicio_actual = hoy.replace(day=1)
+        inicio_anterior = (inicio_actual - timedelta(days=1)).replace(day=1)
+        
+        for anterior, mes in zip(meses, meses[1:]):
+            acumulado = MOTOR_ANALITICA.por_mes.get(mes)
+            valor = acumulado.valor if acumulado else 0.0
+            utilidad = valor - INDICE_GASTOS.raiz.totales(mes)[0]
+            
+            if mes == mes_actual:
+                fin_anterior = min(inicio_anterior + timedelta(days=hoy.day - 1), inicio_actual - timedelta(days=1))
+                base = MOTOR_ANALITICA.valor_entre(inicio_anterior, fin_anterior)
+            else:
+                acumulado_anterior = MOTOR_ANALITICA.por_mes.get(anterior)
+                base = acumulado_anterior.valor if acumulado_anterior else 0.0
             
-            total_gastos += datos['costo']
-            total_cantidad += datos['cantidad']
+            anio, numero = mes.split('-')
+            etiqueta = f"{MESES[int(numero) - 1][:3]} {anio}" + ("†" if mes == mes_actual else "")
+            reporte += f"{etiqueta:<9} ${valor:>11,.2f} ${utilidad:>11,.2f} {crecimiento(valor, base):>7}\n"
         
-        tabla += "─" * 45 + "\n"
-        tabla += f"{'TOTAL':<20} {total_cantidad:>9} ${total_gastos:>13,.2f}\n"
-        tabla += "```"
+        reporte += "```"
+        reporte += f"\n_† Mes en curso: variación contra los primeros {hoy.day} días del mes anterior_\n"
+    
+    reporte += f"\n*Uso: /analitica [{'|'.join(str(d) for d in VENTANAS_ANALITICA)}]*"
+    return reporte
+
+async def ver_analitica(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ver analítica de ventas de una ventana de días"""
+    dias = VENTANAS_ANALITICA[1]
+    
+    if context.args:
+        try:
+            dias = int(context.args[0])
+        except ValueError:
+            dias = None
+        
+        if dias not in VENTANAS_ANALITICA:
+            opciones = ", ".join(str(d) for d in VENTANAS_ANALITICA)
+            await update.message.reply_text(f"❌ Los días deben ser uno de: {opciones}")
+            return
+    
+    await enviar_reporte(update, context, f"analitica:{dias}", lambda: reporte_analitica(dias))
+
+# ============ GRÁFICOS ============
+
+TIPOS_GRAFICO = ('ventas', 'gastos', 'balance')
+# Meses que se muestran en los gráficos mensuales
+MESES_GRAFICO = 6
+# Clientes con porción propia en el gráfico de participación
+CLIENTES_GRAFICO = 6
+
+# Pool pequeño: matplotlib usa bastante memoria por cada gráfico en curso
+POOL_GRAFICOS = ThreadPoolExecutor(max_workers=2, thread_name_prefix='graficos')
+
+graficos_enviados = {}  # tipo -> (versión de los datos, file_id de Telegram)
+
+def version_graficos():
+    """Versión de los datos: cambia con el día, cada fila nueva o cada recarga"""
+    obtener_registros('ventas')
+    obtener_registros('gastos')
+    return (
+        datetime.now().date(),
+        CACHE['ventas'].generacion, len(CACHE['ventas'].registros),
+        CACHE['gastos'].generacion, len(CACHE['gastos'].registros),
+    )
+
+def datos_grafico_ventas(hoy):
+    """Ventas por día y participación por cliente de los últimos 30 días"""
+    dias_ventana = VENTANAS_ANALITICA[1]
+    indice = obtener_indice_clientes()
+    MOTOR_ANALITICA.sincronizar()
+    
+    with MOTOR_ANALITICA.lock:
+        dias = [hoy - timedelta(days=i) for i in range(dias_ventana - 1, -1, -1)]
+        por_dia = MOTOR_ANALITICA.por_dia
+        valores = [por_dia[dia].valor if dia in por_dia else 0 for dia in dias]
+        ventana = MOTOR_ANALITICA.ventana(dias_ventana, hoy)
+        clientes = sorted(
+            ((indice.nombre(clave) if clave in indice.clientes else clave, datos[0])
+             for clave, datos in ventana.clientes.items()),
+            key=lambda cliente: cliente[1],
+            reverse=True
+        )
+    
+    if not ventana.ventas:
+        return None
+    
+    otros = sum(valor for _, valor in clientes[CLIENTES_GRAFICO:])
+    clientes = clientes[:CLIENTES_GRAFICO] + ([("Otros", otros)] if otros > 0 else [])
+    
+    return {
+        'dias': [dia.strftime("%d/%m") for dia in dias],
+        'valores': valores,
+        'clientes': clientes,
+    }
+
+def datos_grafico_gastos(hoy):
+    """Gastos por categoría del mes en curso y por mes"""
+    obtener_registros('gastos')
+    INDICE_GASTOS.sincronizar()
+    meses = ultimos_meses(hoy, MESES_GRAFICO)
+    mes_actual = meses[-1]
+    
+    with INDICE_GASTOS.lock:
+        raiz = INDICE_GASTOS.raiz
+        categorias = sorted(
+            (
+                (nombre, nodo.totales(mes_actual)[0])
+                for nombre, nodo in raiz.hijos.items()
+                if nodo.totales(mes_actual)[1]
+            ),
+            key=lambda categoria: categoria[1]
+        )
+        por_mes = [raiz.totales(mes)[0] for mes in meses]
+    
+    if not categorias:
+        return None
+    
+    return {
+        'periodo': nombre_periodo(mes_actual),
+        'categorias': categorias,
+        'meses': [nombre_periodo(mes) for mes in meses],
+        'por_mes': por_mes,
+    }
+
+def datos_grafico_balance(hoy):
+    """Ventas, gastos y balance por mes"""
+    obtener_registros('ventas')
+    MOTOR_ANALITICA.sincronizar()
+    INDICE_GASTOS.sincronizar()
+    meses = ultimos_meses(hoy, MESES_GRAFICO)
+    
+    with MOTOR_ANALITICA.lock:
+        ventas = [
+            MOTOR_ANALITICA.por_mes[mes].valor if mes in MOTOR_ANALITICA.por_mes else 0
+            for mes in meses
+        ]
+    with INDICE_GASTOS.lock:
+        gastos = [INDICE_GASTOS.raiz.totales(mes)[0] for mes in meses]
+    
+    if not any(ventas) and not any(gastos):
+        return None
+    
+    return {
+        'meses': [nombre_periodo(mes) for mes in meses],
+        'ventas': ventas,
+        'gastos': gastos,
+    }
+
+DATOS_GRAFICO = {
+    'ventas': datos_grafico_ventas,
+    'gastos': datos_grafico_gastos,
+    'balance': datos_grafico_balance,
+}
+
+def dibujar_grafico(tipo, datos):
+    """Dibujar un gráfico como PNG sin pantalla (se ejecuta en POOL_GRAFICOS)"""
+    # Figure sin pyplot: no usa estado global, así que es seguro en varios hilos
+    from matplotlib.figure import Figure
+    
+    figura = Figure(figsize=(9, 8), dpi=100)
+    
+    if tipo == 'ventas':
+        diario, clientes = figura.subplots(2, 1, gridspec_kw={'height_ratios': [1, 1.3]})
         
-        tabla += f"\n*Para ver detalles de un gasto usa: /gasto descripción*"
+        diario.bar(datos['dias'], datos['valores'], color='#2e7d32')
+        diario.set_title("Ventas por día (últimos 30 días)")
+        diario.set_xticks(range(0, len(datos['dias']), 5))
+        diario.tick_params(axis='x', labelrotation=45)
         
-        await update.message.reply_text(tabla, parse_mode='Markdown')
+        nombres, valores = zip(*datos['clientes'])
+        clientes.pie(valores, labels=nombres, autopct='%1.0f%%', startangle=90)
+        clientes.set_title("Participación por cliente (últimos 30 días)")
+    
+    elif tipo == 'gastos':
+        categorias, meses = figura.subplots(2, 1)
         
-    except Exception as e:
-        logger.error(f"Error al leer gastos: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
-
-# ============ VER DETALLES DE UN GASTO (NUEVO) ============
+        nombres, totales = zip(*datos['categorias'])
+        categorias.barh(nombres, totales, color='#c62828')
+        categorias.set_title(f"Gastos por categoría ({datos['periodo']})")
+        
+        meses.bar(datos['meses'], datos['por_mes'], color='#ef6c00')
+        meses.set_title("Gastos por mes")
+        meses.tick_params(axis='x', labelrotation=30)
+    
+    else:
+        eje = figura.subplots()
+        posiciones = range(len(datos['meses']))
+        balance = [venta - gasto for venta, gasto in zip(datos['ventas'], datos['gastos'])]
+        
+        eje.bar([p - 0.2 for p in posiciones], datos['ventas'], width=0.4, label="Ventas", color='#2e7d32')
+        eje.bar([p + 0.2 for p in posiciones], datos['gastos'], width=0.4, label="Gastos", color='#c62828')
+        eje.plot(list(posiciones), balance, marker='o', color='#1565c0', label="Balance")
+        eje.axhline(0, color='gray', linewidth=0.8)
+        eje.set_xticks(list(posiciones), datos['meses'], rotation=30)
+        eje.set_title("Balance mensual")
+        eje.legend()
+    
+    figura.tight_layout()
+    buffer = io.BytesIO()
+    figura.savefig(buffer, format='png')
+    return buffer.getvalue()
 
-async def ver_gasto_detalle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Ver detalles completos de un gasto específico"""
-    if not context.args:
+async def ver_grafico(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /grafico - Enviar un gráfico de ventas, gastos o balance"""
+    tipo = context.args[0].lower() if context.args else ""
+    
+    if tipo not in TIPOS_GRAFICO:
         await update.message.reply_text(
-            "❌ *Uso:* `/gasto descripción`\n\n"
-            "*Ejemplo:* `/gasto Arriendo`",
+            "❌ *Uso:* `/grafico ventas|gastos|balance`\n\n"
+            "*Ejemplo:* `/grafico balance`",
             parse_mode='Markdown'
         )
         return
     
-    descripcion_gasto = " ".join(context.args)
+    nombre = f"grafico:{tipo}"
+    if not await admitir_solicitud(update, nombre):
+        return
     
+    clave = (update.effective_chat.id, nombre)
+    reportes_en_curso.add(clave)
     try:
-        service = get_sheets_service()
+        version = await COALESCEDOR.ejecutar('version_graficos', version_graficos)
         
-        # Leer datos de Gastos
+        # Si los datos no cambiaron se reenvía la imagen ya subida a Telegram
+        enviado = graficos_enviados.get(tipo)
+        if enviado and enviado[0] == version:
+            await update.message.reply_photo(photo=enviado[1])
+            return
+        
+        datos = await COALESCEDOR.ejecutar(
+            f"datos:{tipo}:{version}", lambda: DATOS_GRAFICO[tipo](version[0]))
+        if datos is None:
+            await update.message.reply_text("📊 No hay datos suficientes para el gráfico")
+            return
+        
+        imagen = await COALESCEDOR.ejecutar(
+            f"png:{tipo}:{version}", lambda: dibujar_grafico(tipo, datos), POOL_GRAFICOS)
+        mensaje = await update.message.reply_photo(photo=imagen)
+        graficos_enviados[tipo] = (version, mensaje.photo[-1].file_id)
+        
+    except ImportError:
+        await update.message.reply_text("❌ Los gráficos requieren matplotlib (ver requirements.txt)")
+    except Exception as e:
+        logger.error(f"Error al generar el gráfico {tipo}: {e}")
+        await update.message.reply_text(f"❌ Error al generar el gráfico: {str(e)}")
+    finally:
+        reportes_en_curso.discard(clave)
+        reportes_recientes[clave] = time.monotonic()
+
+# ============ EXPORTAR / IMPORTAR ============
+
+def contar_filas_hoja(service, hoja):
+    """Obtener el número de filas de la cuadrícula sin leer los valores"""
+    result = service.spreadsheets().get(
+        spreadsheetId=SPREADSHEET_ID,
+        fields='sheets.properties(title,gridProperties.rowCount)'
+    ).execute()
+    
+    for sheet in result.get('sheets', []):
+        propiedades = sheet['properties']
+        if propiedades['title'] == HOJAS[hoja]['titulo']:
+            return propiedades['gridProperties']['rowCount']
+    
+    raise ValueError(f"No existe la pestaña {HOJAS[hoja]['titulo']}")
+
+def iterar_filas(service, hoja, tamano_bloque=TAMANO_BLOQUE):
+    """Leer las filas de una hoja por bloques, sin cargarla completa en memoria"""
+    total_filas = contar_filas_hoja(service, hoja)
+    
+    for inicio in range(2, total_filas + 1, tamano_bloque):  # Saltar encabezado
+        fin = min(inicio + tamano_bloque - 1, total_filas)
         result = service.spreadsheets().values().get(
             spreadsheetId=SPREADSHEET_ID,
-            range='Gastos!A:C'
+            range=rango_hoja(hoja, inicio, fin)
         ).execute()
         
-        rows = result.get('values', [])[1:]  # Saltar encabezado
-        
-        # Filtrar por descripción
-        registros = []
-        total_costo = 0
-        nequi_total = 0
-        efectivo_total = 0
+        for row in result.get('values', []):
+            if row:
+                yield row
+
+def generar_csv(filas, encabezado, filas_por_bloque=TAMANO_LOTE):
+    """Convertir filas en bloques de texto CSV"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(encabezado)
+    
+    for i, fila in enumerate(filas, 1):
+        writer.writerow(fila + [''] * (len(encabezado) - len(fila)))
         
-        for i, row in enumerate(rows):
-            try:
-                descripcion = row[0] if len(row) > 0 else ""
-                
-                if descripcion.lower() == descripcion_gasto.lower():
-                    costo = float(row[1]) if len(row) > 1 else 0
-                    metodo = row[2] if len(row) > 2 else "N/A"
-                    
-                    registros.append({
-                        'numero': i + 1,
-                        'costo': costo,
-                        'metodo': metodo
-                    })
-                    
-                    total_costo += costo
-                    
-                    if metodo == "Nequi":
-                        nequi_total += costo
-                    elif metodo == "Efectivo":
-                        efectivo_total += costo
-                    
-            except (ValueError, IndexError):
+        if i % filas_por_bloque == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def abrir_csv(ruta, modo):
+    """Abrir un archivo CSV, comprimido con gzip si termina en .gz"""
+    if ruta.endswith('.gz'):
+        return gzip.open(ruta, modo + 't', encoding='utf-8', newline='')
+    return open(ruta, modo, encoding='utf-8', newline='')
+
+def exportar_hoja(service, hoja, ruta):
+    """Exportar una hoja a CSV en streaming. Retorna el número de registros"""
+    registros = 0
+    
+    def contar(filas):
+        nonlocal registros
+        for fila in filas:
+            registros += 1
+            yield fila
+    
+    with abrir_csv(ruta, 'w') as archivo:
+        for bloque in generar_csv(contar(iterar_filas(service, hoja)), HOJAS[hoja]['columnas']):
+            archivo.write(bloque)
+    
+    return registros
+
+def validar_fila(hoja, fila, ocurrencias=None):
+    """Normalizar una fila importada. Retorna None si no es válida"""
+    columnas = HOJAS[hoja]['columnas']
+    fila = [valor.strip() for valor in fila[:len(columnas)]]
+    fila += [''] * (len(columnas) - len(fila))
+    
+    if not fila[0]:
+        return None
+    
+    try:
+        for i in HOJAS[hoja]['numericas']:
+            fila[i] = float(fila[i]) if fila[i] else 0
+    except ValueError:
+        return None
+    
+    # Las filas exportadas conservan su ID; las demás reciben uno estable calculado con
+    # su contenido y las veces que ya apareció en el archivo (no con su posición, que
+    # cambia con líneas en blanco o reordenamientos, ni con el nombre canónico del
+    # cliente, que depende del índice)
+    columna = HOJAS[hoja]['id']
+    if not fila[columna]:
+        huella = contenido_importado(hoja, fila)
+        ocurrencia = 1
+        if ocurrencias is not None:
+            ocurrencia = ocurrencias[huella] = ocurrencias.get(huella, 0) + 1
+        fila[columna] = id_importado(huella, ocurrencia)
+    
+    if hoja == 'ventas':
+        fila[0] = obtener_indice_clientes().canonico(fila[0])
+    
+    return fila
+
+def iterar_csv(ruta, hoja, estadisticas):
+    """Leer las filas válidas de un CSV en streaming, contando las inválidas"""
+    columnas = HOJAS[hoja]['columnas']
+    ocurrencias = {}  # huella del contenido -> veces vista en el archivo
+    
+    with abrir_csv(ruta, 'r') as archivo:
+        for fila in csv.reader(archivo):
+            if not any(valor.strip() for valor in fila):
                 continue
+            
+            # Saltar encabezado (también el de archivos exportados antes de la columna ID)
+            encabezado = [valor.strip() for valor in fila[:len(columnas)]]
+            if encabezado == columnas[:len(encabezado)]:
+                continue
+            
+            valida = validar_fila(hoja, fila, ocurrencias)
+            if valida is None:
+                estadisticas['invalidas'] += 1
+                continue
+            
+            yield valida
+
+def agrupar_en_lotes(elementos, tamano_lote):
+    """Agrupar un iterable en listas de tamaño fijo"""
+    lote = []
+    for elemento in elementos:
+        lote.append(elemento)
+        if len(lote) == tamano_lote:
+            yield lote
+            lote = []
+    
+    if lote:
+        yield lote
+
+def importar_hoja(service, hoja, ruta, tamano_lote=TAMANO_LOTE):
+    """Cargar un CSV en una hoja con una llamada a la API por lote, saltando las filas ya guardadas"""
+    estadisticas = {'importadas': 0, 'invalidas': 0, 'duplicadas': 0, 'lotes': 0}
+    columna = HOJAS[hoja]['id']
+    vistos = set()
+    
+    # La caché trae los IDs que ya están en la hoja
+    sondear_cambios(forzar=True)
+    
+    def nuevas(filas):
+        for fila in filas:
+            if fila[columna] in vistos:
+                estadisticas['duplicadas'] += 1
+                continue
+            vistos.add(fila[columna])
+            yield fila
+    
+    for lote in agrupar_en_lotes(nuevas(iterar_csv(ruta, hoja, estadisticas)), tamano_lote):
+        escritas, confirmadas = agregar_filas(service, hoja, lote)
+        
+        # Las confirmadas llegaron en un intento de esta importación que dio error
+        estadisticas['importadas'] += escritas + confirmadas
+        estadisticas['duplicadas'] += len(lote) - escritas - confirmadas
+        if escritas or confirmadas:
+            estadisticas['lotes'] += 1
+    
+    marcar_pendiente()
+    return estadisticas
+
+async def exportar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /exportar - Enviar una hoja como archivo CSV"""
+    if not context.args or context.args[0].lower() not in HOJAS:
+        await update.message.reply_text(
+            "❌ *Uso:* `/exportar ventas|gastos [gz]`\n\n"
+            "*Ejemplo:* `/exportar ventas gz`",
+            parse_mode='Markdown'
+        )
+        return
+    
+    hoja = context.args[0].lower()
+    comprimir = len(context.args) > 1 and context.args[1].lower() == 'gz'
+    extension = '.csv.gz' if comprimir else '.csv'
+    
+    descriptor, ruta = tempfile.mkstemp(suffix=extension)
+    os.close(descriptor)
+    
+    try:
+        # La lectura por bloques corre en un hilo para no bloquear el bot
+        registros = await asyncio.to_thread(lambda: exportar_hoja(get_sheets_service(), hoja, ruta))
+        fecha = datetime.now().strftime("%Y%m%d")
         
-        if not registros:
-            await update.message.reply_text(f"❌ No hay gastos registrados para: *{descripcion_gasto}*", parse_mode='Markdown')
-            return
-        
-        # Crear reporte detallado
-        reporte = f"💰 *DETALLES DE GASTO: {descripcion_gasto.upper()}*\n\n"
-        reporte += "```"
-        reporte += f"{'#':<4} {'Costo':<15} {'Método':<12}\n"
-        reporte += "─" * 31 + "\n"
-        
-        for reg in registros:
-            reporte += f"{reg['numero']:<4} ${reg['costo']:>13,.2f} {str(reg['metodo']):<12}\n"
+        with open(ruta, 'rb') as archivo:
+            await update.message.reply_document(
+                document=archivo,
+                filename=f"{hoja}_{fecha}{extension}",
+                caption=f"📦 {HOJAS[hoja]['titulo']}: {registros} registros"
+            )
         
-        reporte += "─" * 31 + "\n"
-        reporte += f"{'TOTAL':<4} ${total_costo:>13,.2f}\n"
-        reporte += "```"
+    except Exception as e:
+        logger.error(f"Error al exportar {hoja}: {e}")
+        await update.message.reply_text(f"❌ Error al exportar: {str(e)}")
+    finally:
+        os.remove(ruta)
+
+async def importar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Comando /importar - Iniciar la carga de un CSV"""
+    if not context.args or context.args[0].lower() not in HOJAS:
+        await update.message.reply_text(
+            "❌ *Uso:* `/importar ventas|gastos`\n\n"
+            "*Ejemplo:* `/importar gastos`",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
+    
+    hoja = context.args[0].lower()
+    context.user_data['importar'] = hoja
+    
+    await update.message.reply_text(
+        f"📥 *Importar {HOJAS[hoja]['titulo']}*\n\n"
+        f"Envía el archivo .csv o .csv.gz con las columnas:\n"
+        f"`{','.join(HOJAS[hoja]['columnas'])}`\n"
+        "(la columna ID es opcional)\n\n"
+        f"Usa /cancel para cancelar",
+        parse_mode='Markdown'
+    )
+    return AWAITING_ARCHIVO_IMPORTAR
+
+async def recibir_archivo_importar(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Recibir el CSV y cargarlo por lotes en Google Sheets"""
+    documento = update.message.document
+    nombre = (documento.file_name or "").lower()
+    
+    if not nombre.endswith(('.csv', '.csv.gz')):
+        await update.message.reply_text("❌ Por favor, envía un archivo .csv o .csv.gz")
+        return AWAITING_ARCHIVO_IMPORTAR
+    
+    hoja = context.user_data['importar']
+    descriptor, ruta = tempfile.mkstemp(suffix='.csv.gz' if nombre.endswith('.gz') else '.csv')
+    os.close(descriptor)
+    
+    try:
+        archivo = await documento.get_file()
+        await archivo.download_to_drive(ruta)
         
-        # Agregar resumen
-        reporte += f"\n📊 *Información del Gasto:*\n"
-        reporte += f"• Registros: {len(registros)}\n"
-        reporte += f"• Costo Total: ${total_costo:,.2f}\n"
-        reporte += f"• Nequi: ${nequi_total:,.2f}\n"
-        reporte += f"• Efectivo: ${efectivo_total:,.2f}"
+        estadisticas = await asyncio.to_thread(lambda: importar_hoja(get_sheets_service(), hoja, ruta))
         
-        await update.message.reply_text(reporte, parse_mode='Markdown')
+        await update.message.reply_text(
+            f"✅ *Importación completada*\n\n"
+            f"Hoja: {HOJAS[hoja]['titulo']}\n"
+            f"Registros importados: {estadisticas['importadas']}\n"
+            f"Filas inválidas: {estadisticas['invalidas']}\n"
+            f"Ya registradas: {estadisticas['duplicadas']}\n"
+            f"Lotes enviados: {estadisticas['lotes']}",
+            parse_mode='Markdown'
+        )
         
     except Exception as e:
-        logger.error(f"Error al leer gasto: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
+        logger.error(f"Error al importar {hoja}: {e}")
+        await update.message.reply_text(f"❌ Error al importar: {str(e)}")
+    finally:
+        os.remove(ruta)
+    
+    await start(update, context)
+    return ConversationHandler.END
+
+def cli(argv):
+    """Exportar o importar sin iniciar el bot"""
+    if len(argv) != 3 or argv[0] not in ('exportar', 'importar') or argv[1] not in HOJAS:
+        print("Uso: python bot.py exportar|importar ventas|gastos archivo.csv[.gz]")
+        return 1
+    
+    accion, hoja, ruta = argv
+    service = get_sheets_service()
+    
+    if accion == 'exportar':
+        registros = exportar_hoja(service, hoja, ruta)
+        print(f"✅ {registros} registros exportados a {ruta}")
+    else:
+        estadisticas = importar_hoja(service, hoja, ruta)
+        print(
+            f"✅ {estadisticas['importadas']} registros importados en "
+            f"{estadisticas['lotes']} lotes ({estadisticas['invalidas']} filas inválidas, "
+            f"{estadisticas['duplicadas']} ya registradas)"
+        )
+    return 0
 
 # ============ MANEJADOR DE BOTONES ============
 
@@ -775,24 +2413,28 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     elif texto == '💸 Agregar Gasto':
         return await agregar_gasto(update, context)
     elif texto == '📊 Ver Total de Ventas':
-        await ver_total_ventas(update, context)
-        await start(update, context)
+        await enviar_reporte(update, context, 'total_ventas', reporte_total_ventas, mostrar_menu=True)
         return ConversationHandler.END
     elif texto == '📉 Ver Total de Gastos':
-        await ver_total_gastos(update, context)
-        await start(update, context)
+        await enviar_reporte(update, context, 'total_gastos', reporte_total_gastos, mostrar_menu=True)
         return ConversationHandler.END
     elif texto == '📋 Ver Balance':
-        await ver_balance(update, context)
-        await start(update, context)
+        await enviar_reporte(update, context, 'balance', reporte_balance, mostrar_menu=True)
+        return ConversationHandler.END
+    elif texto == '📂 Gastos por Categoría':
+        mes = parsear_periodo('mes')
+        await enviar_reporte(
+            update, context,
+            f"categorias:None:{mes}",
+            lambda: reporte_categorias(mes=mes),
+            mostrar_menu=True
+        )
         return ConversationHandler.END
     elif texto == '👥 Resumen Clientes':
-        await ver_resumen_clientes(update, context)
-        await start(update, context)
+        await enviar_reporte(update, context, 'resumen_clientes', reporte_resumen_clientes, mostrar_menu=True)
         return ConversationHandler.END
     elif texto == '💰 Resumen Gastos':
-        await ver_resumen_gastos(update, context)
-        await start(update, context)
+        await enviar_reporte(update, context, 'resumen_gastos', reporte_resumen_gastos, mostrar_menu=True)
         return ConversationHandler.END
     else:
         await update.message.reply_text("❌ Opción no reconocida. Por favor, usa los botones del menú")
@@ -809,6 +2451,93 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await start(update, context)
     return ConversationHandler.END
 
+# ============ ARRANQUE Y MÉTRICAS ============
+
+# Tiempos de arranque en segundos desde INICIO_PROCESO
+metricas_arranque = {'listo': None, 'primera_respuesta': None}
+
+async def calentar_cache() -> None:
+    """Preparar el acceso a Google Sheets sin bloquear la recepción de mensajes"""
+    inicio = time.perf_counter()
+    
+    try:
+        credentials, _ = await asyncio.to_thread(preparar_sheets)
+        
+        from google.auth.transport.requests import Request
+        await asyncio.to_thread(credentials.refresh, Request())
+        
+        await asyncio.to_thread(sondear_cambios, True)
+        
+        logger.info(f"🔥 Caché de Google Sheets lista en {time.perf_counter() - inicio:.2f}s")
+    except Exception as e:
+        logger.warning(f"No se pudo precalentar Google Sheets: {e}")
+
+async def vigilar_cambios() -> None:
+    """Sondear periódicamente la pestaña de control para mantener la caché al día"""
+    while True:
+        await asyncio.sleep(INTERVALO_SONDEO)
+        try:
+            await asyncio.to_thread(sondear_cambios)
+        except Exception as e:
+            logger.warning(f"Error al sondear cambios: {e}")
+
+async def post_init(app: Application) -> None:
+    """Registrar el arranque y lanzar el precalentamiento en segundo plano"""
+    metricas_arranque['listo'] = time.perf_counter() - INICIO_PROCESO
+    logger.info(f"⏱️ Bot listo en {metricas_arranque['listo']:.2f}s")
+    
+    app.bot_data['tareas'] = [
+        asyncio.create_task(calentar_cache()),
+        asyncio.create_task(vigilar_cambios()),
+    ]
+
+async def post_shutdown(app: Application) -> None:
+    """Detener las tareas en segundo plano"""
+    tareas = app.bot_data.get('tareas', [])
+    for tarea in tareas:
+        tarea.cancel()
+    await asyncio.gather(*tareas, return_exceptions=True)
+
+# Métodos de la API de Telegram con los que el bot responde a un usuario
+METODOS_RESPUESTA = {'sendMessage', 'sendPhoto', 'sendDocument', 'answerInlineQuery'}
+
+def registrar_primera_respuesta():
+    """Medir el tiempo hasta la primera respuesta del bot"""
+    if metricas_arranque['primera_respuesta'] is None:
+        metricas_arranque['primera_respuesta'] = time.perf_counter() - INICIO_PROCESO
+        logger.info(f"⏱️ Primera respuesta a los {metricas_arranque['primera_respuesta']:.2f}s del arranque")
+
+class SolicitudMedida(HTTPXRequest):
+    """Cliente HTTP del bot que registra la primera respuesta enviada a un usuario"""
+    
+    async def do_request(self, url, method, *args, **kwargs):
+        resultado = await super().do_request(url, method, *args, **kwargs)
+        if url.rsplit('/', 1)[-1] in METODOS_RESPUESTA:
+            registrar_primera_respuesta()
+        return resultado
+
+async def estado(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Comando /estado - Mostrar métricas de arranque y de la caché"""
+    def formatear(segundos):
+        return f"{segundos:.2f}s" if segundos is not None else "pendiente"
+    
+    mensaje = (
+        f"🩺 *Estado del Bot*\n\n"
+        f"🚀 Listo en: {formatear(metricas_arranque['listo'])}\n"
+        f"💬 Primera respuesta: {formatear(metricas_arranque['primera_respuesta'])}\n"
+        f"⏳ Activo hace: {formatear(time.perf_counter() - INICIO_PROCESO)}\n\n"
+        f"🗂️ *Caché*\n"
+        f"Control: {'activo' if estado_sondeo['control'] else 'no disponible'}\n"
+        f"Sondeos: {estado_sondeo['sondeos']} • Lecturas: {estado_sondeo['lecturas']}\n"
+    )
+    
+    for hoja, cache in CACHE.items():
+        mensaje += f"{HOJAS[hoja]['titulo']}: {cache.filas} filas (generación {cache.generacion})\n"
+        if cache.duplicadas:
+            mensaje += f"  Duplicadas ignoradas: {cache.duplicadas}\n"
+    
+    await update.message.reply_text(mensaje, parse_mode='Markdown')
+
 # ============ MAIN - CONFIGURAR EL BOT ============
 
 def main():
@@ -816,7 +2545,7 @@ def main():
     print("🤖 Iniciando bot de gastos y ganancias...")
     
     # Crear aplicación
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = ApplicationBuilder().token(TOKEN).request(SolicitudMedida()).post_init(post_init).post_shutdown(post_shutdown).build()
     
     # Conversación para agregar compra
     conv_handler_compra = ConversationHandler(
@@ -842,31 +2571,50 @@ def main():
         ],
         states={
             AWAITING_GASTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_gasto)],
+            AWAITING_CATEGORIA_GASTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_categoria_gasto)],
+            AWAITING_SUBCATEGORIA_GASTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_subcategoria_gasto)],
             AWAITING_COSTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_costo)],
             AWAITING_METODO_GASTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_metodo_gasto)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
     )
     
+    # Conversación para importar un CSV
+    conv_handler_importar = ConversationHandler(
+        entry_points=[CommandHandler('importar', importar)],
+        states={
+            AWAITING_ARCHIVO_IMPORTAR: [MessageHandler(filters.Document.ALL, recibir_archivo_importar, block=False)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+    )
+    
     # Agregar handlers
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('help', help_command))
-    app.add_handler(CommandHandler('totventas', ver_total_ventas))
-    app.add_handler(CommandHandler('totgastos', ver_total_gastos))
-    app.add_handler(CommandHandler('balance', ver_balance))
-    app.add_handler(CommandHandler('resumen', ver_resumen_clientes))
-    app.add_handler(CommandHandler('cliente', ver_cliente_detalle))
-    app.add_handler(CommandHandler('resumen_gastos', ver_resumen_gastos))
-    app.add_handler(CommandHandler('gasto', ver_gasto_detalle))
+    app.add_handler(CommandHandler('totventas', ver_total_ventas, block=False))
+    app.add_handler(CommandHandler('totgastos', ver_total_gastos, block=False))
+    app.add_handler(CommandHandler('balance', ver_balance, block=False))
+    app.add_handler(CommandHandler('resumen', ver_resumen_clientes, block=False))
+    app.add_handler(CommandHandler('cliente', ver_cliente_detalle, block=False))
+    app.add_handler(CommandHandler('resumen_gastos', ver_resumen_gastos, block=False))
+    app.add_handler(CommandHandler('gasto', ver_gasto_detalle, block=False))
+    app.add_handler(CommandHandler('categorias', ver_categorias, block=False))
+    app.add_handler(CommandHandler('analitica', ver_analitica, block=False))
+    app.add_handler(CommandHandler('grafico', ver_grafico, block=False))
+    app.add_handler(CommandHandler('exportar', exportar, block=False))
+    app.add_handler(CommandHandler('estado', estado))
+    app.add_handler(InlineQueryHandler(sugerir_clientes))
     
     # Handlers de conversación
     app.add_handler(conv_handler_compra)
     app.add_handler(conv_handler_gasto)
+    app.add_handler(conv_handler_importar)
     
-    # Handler general para botones
+    # Handler general para botones (sin bloquear, los reportes se calculan en hilos)
     app.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND,
-        handle_buttons
+        handle_buttons,
+        block=False
     ))
     
     # Iniciar el bot
@@ -874,4 +2622,6 @@ def main():
     app.run_polling()
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     main()